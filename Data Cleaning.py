@@ -152,17 +152,53 @@ The final return value for a "way" element should look something like:
                'key': 'building_id',
                'type': 'chicago',
                'value': '366409'}]}
+
+### If the element top level tag is "relation":
+The dictionary has the format {"relation": ..., "relation_tags": ..., "relation_members": ...}
+"relation" holds the same top level attributes as "way", and "relation_tags" follows the same
+rules as "node_tags". "relation_members" holds one dictionary per member child tag, with the
+fields:
+- id: the top level element (relation) id
+- member_type: the type attribute of the member tag ("node", "way" or "relation")
+- member_id: its ref attribute value
+- role: its role attribute value (often empty)
+- position: the index starting at 0 of the member tag within the relation element
 """
 
 import csv
 import codecs
+from functools import partial
+from itertools import count, imap, izip, repeat
+import multiprocessing
+import os
 import pprint
 import re
-import xml.etree.cElementTree as ET
+import shutil
+import tempfile
 
-import cerberus
+try:
+    import cerberus
+except ImportError:
+    cerberus = None
 
+import columnar
+import compressed_io
+import osm_shards
+import run_metrics
 import schema
+from audit import StreamingAudit, make_audit, write_json, write_report
+from checkpoint import CHECKPOINT_EVERY, Checkpointer, load_checkpoint
+from cleaning_rules import CleaningRules
+from int_arrays import int64_array
+from node_index import WayGeometryWriter
+from osm_merge import ExtractMerger
+from osm_parser import (DEFAULT_PARSER, ELEMENT_TYPES, OsmElement, from_etree, iter_changes,
+                        iter_elements)
+from relation_members import RelationMembers
+from schema_validator import CompiledValidator
+from spatial_filter import SpatialFilter
+from sqlite_sink import UPDATE_JOURNAL_MODE, UPDATE_SYNCHRONOUS, SQLiteSink
+from threaded_io import ThreadedReader, ThreadedWriter
 
 OSM_PATH = "san-jose_california.osm"
 
@@ -171,10 +207,22 @@ NODE_TAGS_PATH = "nodes_tags_sanjose.csv"
 WAYS_PATH = "ways_sanjose.csv"
 WAY_NODES_PATH = "ways_nodes_sanjose.csv"
 WAY_TAGS_PATH = "ways_tags_sanjose.csv"
+WAY_GEOMETRY_PATH = "ways_geometry_sanjose.csv"
+RELATIONS_PATH = "relations_sanjose.csv"
+RELATION_TAGS_PATH = "relations_tags_sanjose.csv"
+RELATION_MEMBERS_PATH = "relations_members_sanjose.csv"
+AUDIT_REPORT_PATH = "audit_sanjose.txt"
+AUDIT_JSON_PATH = "audit_sanjose.json"
+METRICS_PATH = "metrics_sanjose.json"
+CHECKPOINT_PATH = "checkpoint_sanjose.json"
+DB_PATH = "sanjose.db"
+COLUMNAR_DIR = "columnar_sanjose"
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 street_regex=re.compile(r'\S+$')
+NON_DIGITS = re.compile(r'\D+')
+LEADING_ONE = re.compile(r'^1')
 
 SCHEMA = schema.schema
 
@@ -184,135 +232,173 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+WAY_GEOMETRY_FIELDS = ['id', 'min_lat', 'min_lon', 'max_lat', 'max_lon', 'missing_nodes', 'wkt']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+RELATION_MEMBERS_FIELDS = ['id', 'member_type', 'member_id', 'role', 'position']
+
+# Output files and their columns in the order process_map writes them
+OUTPUT_PATHS = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH,
+                RELATIONS_PATH, RELATION_TAGS_PATH, RELATION_MEMBERS_PATH]
+OUTPUT_FIELDS = [NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS,
+                 RELATION_FIELDS, RELATION_TAGS_FIELDS, RELATION_MEMBERS_FIELDS]
+OUTPUT_TABLES = ['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags',
+                 'relations', 'relations_tags', 'relations_members']
+# Indexes of the outputs holding the rows of each element type, the first one has the versions
+ELEMENT_TABLES = {'node': (0, 1), 'way': (2, 3, 4), 'relation': (5, 6, 7)}
+# The schema field of each of the ELEMENT_TABLES
+SCHEMA_FIELDS = {'node': ('node', 'node_tags'), 'way': ('way', 'way_nodes', 'way_tags'),
+                 'relation': ('relation', 'relation_tags', 'relation_members')}
+OUTPUT_FORMATS = ('csv', 'sqlite', 'columnar')
+VALIDATORS = ('compiled', 'cerberus')
+SHARD_COPY_SIZE = 1 << 20
+WRITE_BUFFER = 1 << 20
 Street_name_to_be_updated= {"Ln" :"Lane","Rd":"Road","ave":"Avenue","Ave":"Avenue","court":"Ct", "Blvd":"Boulevard",\
                            "Hwy":"Highway","Dr":"Drive","street":"Street","St":"Street","Sq":"Square",\
                             "Blvd.":"Boulevard"}
-san_jose_zipcodes=["94088","94089","94538","94560","95002","95008","95013","95035","95037","95050","95054","95101",\
+san_jose_zipcodes=set(["94088","94089","94538","94560","95002","95008","95013","95035","95037","95050","95054","95101",\
                    "95103","95106","95108","95109","95110","95111","95112","95113","95115","95116","95117","95118",\
                    "95119","95120","95121","95122","95123","95124","95125","95126","95127","95128","95129","95130",\
                    "95131","95132","95133","95134","95135","95136","95138","95139","95141","95148","95150","95151",\
                    "95152","95153","95154","95155","95156","95157","95158","95160","95161","95164","95170","95172",\
-                   "95173","95190","95191","95192","95193","95194","95196"]
+                   "95173","95190","95191","95192","95193","95194","95196"])
 
-san_jose_citynames=["San jose","San Jose","San José".decode("utf8"),"san jose"]
+# "San José" is listed both decoded (ElementTree parsers) and utf-8 encoded (expat parser). A set
+# only compares values with the same hash, so str and unicode are never compared with each other
+san_jose_citynames=set(["San jose","San Jose","San José".decode("utf8"),"San José","san jose"])
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
-
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
-    ignore_node=False
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular', compact=False,
+                  relation_attr_fields=RELATION_FIELDS):
+    """Clean and shape node, way or relation element to Python dict
+
+    element is an OsmElement from osm_parser.iter_elements; iterparse Elements are converted first.
+    Returns None if one of the cleaning rules drops the element.
+
+    With compact=True the rows are tuples in the order of the *_FIELDS lists instead of dicts,
+    "way_nodes" is a 64-bit int array of the node refs (the position is the index in the array) and
+    "relation_members" a relation_members.RelationMembers. That is what write_elements writes;
+    expand_element turns it back into the dict format."""
+    if not isinstance(element, OsmElement):
+        element = from_etree(element)
+
+    attrib = element.attrib
     if element.tag == "node":
-        for node_attributes in NODE_FIELDS:
-            node_attribs[node_attributes]=element.attrib[node_attributes]
-        for child in element:
-            tag={}
-            m = PROBLEMCHARS.search(child.attrib["k"])
-            if m:
-                continue
-            else:
-                tag["id"]=element.attrib["id"]
-                if child.attrib["k"]=="addr:street": 
-                    updated_name=update_street_names(child.attrib["v"])
-                    tag["value"]=updated_name
-                elif child.attrib["k"]=="addr:postcode":
-                    correct_sanjose_zipcode=clean_postcode(child.attrib["v"])
-                    if correct_sanjose_zipcode is not None:
-                        tag["value"]=correct_sanjose_zipcode
-                    else:
-                        return
-                elif child.attrib["k"]=="phone":
-                    updated_number=clean_phone(child.attrib["v"])
-                    tag["value"]=updated_number
-                elif child.attrib["k"] =="addr:city":
-                    city_name=child.attrib["v"]
-                    updated_city_name=clean_sanjose_cityname(city_name)
-                    if updated_city_name is not None:
-                        tag["value"]=updated_city_name
-                    else:
-                        return
-                else:
-                    tag["value"]=child.attrib["v"]
-                if ":" in child.attrib["k"]:
-                    tag["type"],tag["key"]=child.attrib["k"].split(":",1)
-                else:
-                    tag["key"]=child.attrib["k"]
-                    tag["type"]='regular'
-                tags.append(tag)
+        tags = shape_tags(attrib["id"], element.tags, problem_chars, default_tag_type, compact)
+        if tags is None:
+            return
+        if compact:
+            node_attribs = tuple([attrib[field] for field in node_attr_fields])
+        else:
+            node_attribs = dict((field, attrib[field]) for field in node_attr_fields)
         return {'node': node_attribs, 'node_tags': tags}
-    elif element.tag=="way":
-        count=0
-        for way_attributes in WAY_FIELDS:
-            way_attribs[way_attributes]=element.attrib[way_attributes]
-        for child in element:
-            tag={}
-            nd={}
-            if child.tag =="tag":
-                m = PROBLEMCHARS.search(child.attrib["k"])
-                if m:
-                    continue
-                else:
-                    tag["id"]=element.attrib["id"]
-                if child.attrib["k"]=="addr:street": 
-                    updated_name=update_street_names(child.attrib["v"])
-                    tag["value"]=updated_name
-                elif child.attrib["k"]=="addr:postcode":
-                    correct_sanjose_zipcode=clean_postcode(child.attrib["v"])
-                    if correct_sanjose_zipcode is not None:
-                        tag["value"]=correct_sanjose_zipcode
-                    else:
-                        return
-                elif child.attrib["k"]=="phone":
-                    updated_number=clean_phone(child.attrib["v"])
-                    tag["value"]=updated_number
-                else:
-                    tag["value"]=child.attrib["v"]
-                if ":" in child.attrib["k"]:
-                    tag["type"],tag["key"]=child.attrib["k"].split(":",1)
-                else:
-                    tag["key"]=child.attrib["k"]
-                    tag["type"]='regular'
-                tags.append(tag)
-            elif child.tag=="nd":
-                nd["id"]=element.attrib["id"]
-                nd["node_id"]=child.attrib["ref"]
-                nd["position"]=count
-                way_nodes.append(nd)
-                count=count+1
+    elif element.tag == "way":
+        tags = shape_tags(attrib["id"], element.tags, problem_chars, default_tag_type, compact)
+        if tags is None:
+            return
+        way_id = attrib["id"]
+        if compact:
+            way_attribs = tuple([attrib[field] for field in way_attr_fields])
+            way_nodes = int64_array([int(ref) for ref in element.refs])
+        else:
+            way_attribs = dict((field, attrib[field]) for field in way_attr_fields)
+            way_nodes = [{"id": way_id, "node_id": ref, "position": position}
+                         for position, ref in enumerate(element.refs)]
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+    elif element.tag == "relation":
+        tags = shape_tags(attrib["id"], element.tags, problem_chars, default_tag_type, compact)
+        if tags is None:
+            return
+        relation_id = attrib["id"]
+        if compact:
+            relation_attribs = tuple([attrib[field] for field in relation_attr_fields])
+            members = RelationMembers(element.members)
+        else:
+            relation_attribs = dict((field, attrib[field]) for field in relation_attr_fields)
+            members = [{"id": relation_id, "member_type": member_type, "member_id": ref,
+                        "role": role, "position": position}
+                       for position, (member_type, ref, role) in enumerate(element.members)]
+        return {'relation': relation_attribs, 'relation_members': members,
+                'relation_tags': tags}
+
+
+def shape_tags(element_id, tags, problem_chars=PROBLEMCHARS, default_tag_type='regular',
+               compact=False):
+    """Clean and shape the (k, v) secondary tags of an element into a list of tag dicts.
+
+    Keys with problem characters are skipped. Values of keys in CLEANING_RULES go through their
+    cleaner; if a cleaner returns None the whole element is dropped and None is returned.
+    With compact=True the tags are (id, key, value, type) tuples instead."""
+    shaped = []
+    get_cleaner = CLEANING_RULES.get
+    for key, value in tags:
+        if problem_chars.search(key):
+            continue
+        cleaner = get_cleaner(key)
+        if cleaner is not None:
+            value = cleaner(value)
+            if value is None:
+                return None
+        if ":" in key:
+            tag_type, tag_key = key.split(":", 1)
+        else:
+            tag_type, tag_key = default_tag_type, key
+        if compact:
+            shaped.append((element_id, tag_key, value, tag_type))
+        else:
+            shaped.append({"id": element_id, "key": tag_key, "value": value, "type": tag_type})
+    return shaped
+
+
+def way_node_rows(way_id, way_nodes):
+    """Yield the (id, node_id, position) rows of a compact way_nodes array"""
+    return izip(repeat(way_id), way_nodes, count())
+
+
+def expand_element(el):
+    """Turn an element shaped with compact=True into the dict format of shape_element"""
+    if 'node' in el:
+        return {'node': dict(zip(NODE_FIELDS, el['node'])),
+                'node_tags': [dict(zip(NODE_TAGS_FIELDS, tag)) for tag in el['node_tags']]}
+    if 'relation' in el:
+        relation_id = el['relation'][0]
+        return {'relation': dict(zip(RELATION_FIELDS, el['relation'])),
+                'relation_members': [dict(zip(RELATION_MEMBERS_FIELDS, row))
+                                     for row in el['relation_members'].rows(relation_id)],
+                'relation_tags': [dict(zip(RELATION_TAGS_FIELDS, tag))
+                                  for tag in el['relation_tags']]}
+    way_id = el['way'][0]
+    return {'way': dict(zip(WAY_FIELDS, el['way'])),
+            'way_nodes': [dict(zip(WAY_NODES_FIELDS, row))
+                          for row in way_node_rows(way_id, el['way_nodes'])],
+            'way_tags': [dict(zip(WAY_TAGS_FIELDS, tag)) for tag in el['way_tags']]}
+
+
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
 
-"""If street name is in  the dictionary Street_name_to_be_updated, then modify the current street name with the value
+"""If the last word of the street name is in the dictionary Street_name_to_be_updated, then replace it with the value
 in the dictionary. If the street name doesnt exist in the dictionary, the return the street name as is"""
 def update_street_names(street_name):
     m=street_regex.search(street_name)
-    if m.group() in Street_name_to_be_updated.keys():
-        street_name=re.sub(m.group(),Street_name_to_be_updated[m.group()], street_name)
+    if m and m.group() in Street_name_to_be_updated:
+        street_name=street_name[:m.start()]+Street_name_to_be_updated[m.group()]
     return street_name
 
 """If the postcode contains - (95124-3452), then remove the - else keep it as is. Check to see if the postcode exists in
-san_jose_zipcodes list. This lisy contains all the valid san jose zipcodes only. If the postcode is in this list, process
+san_jose_zipcodes set. This set contains all the valid san jose zipcodes only. If the postcode is in this set, process
 it forward to add it in the csv else discard the whole element that belongs to a non san jose zipcode"""
 def clean_postcode(postcode):
-    clean_postcode=None
-    if "-" in postcode:
-            clean_postcode_list=postcode.split("-")
-            clean_postcode=clean_postcode_list[0]
-    else:
-        clean_postcode=postcode
+    clean_postcode=postcode.split("-",1)[0]
     if clean_postcode in san_jose_zipcodes:
         return clean_postcode
 
 """ Check the phone number and remove any non number character from the phone. For example -,"" should be replaced by "".
 After this step, remove the 1 from the start of the phone number"""
 def clean_phone(phoneNumber):
-    updated_number_old=re.sub(r'\D+',"",phoneNumber)
-    updated_number=re.sub(r'^1',"",updated_number_old)
+    updated_number_old=NON_DIGITS.sub("",phoneNumber)
+    updated_number=LEADING_ONE.sub("",updated_number_old)
     return updated_number
 
 """ San jose spelling is inconsistent in the data. This function converts every spelling to "San Jose" """
@@ -322,25 +408,40 @@ def clean_sanjose_cityname(cityname):
     else:
         return None
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+# Cleaning rules shared by nodes and ways: tag key -> cleaner. A cleaner returning None drops the element
+CLEANING_RULES = CleaningRules()
+CLEANING_RULES.register("addr:street", update_street_names)
+CLEANING_RULES.register("addr:postcode", clean_postcode)
+CLEANING_RULES.register("phone", clean_phone)
+CLEANING_RULES.register("addr:city", clean_sanjose_cityname)
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+# Tag keys whose values are changed by one of the cleaning functions
+CLEANED_KEYS = frozenset(CLEANING_RULES.keys())
 
 
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
     if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
-        message_string = "\nElement of type '{0}' has the following errors:\n{1}"
-        error_string = pprint.pformat(errors)
-        
-        raise Exception(message_string.format(field, error_string))
+        raise_validation_error(validator.errors)
+
+
+def validate_compact(tag, el, validator):
+    """validate_element for an element shaped with compact=True: a CompiledValidator checks its
+    row tuples as they are, other validators get the expanded dicts"""
+    if not isinstance(validator, CompiledValidator):
+        validate_element(expand_element(el), validator)
+        return
+    for index, field, rows in izip(ELEMENT_TABLES[tag], SCHEMA_FIELDS[tag], element_rows(tag, el)):
+        if field in SCHEMA and not validator.validate_rows(field, OUTPUT_FIELDS[index], rows):
+            raise_validation_error(validator.errors)
+
+
+def raise_validation_error(errors):
+    field, errors = next(errors.iteritems())
+    message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+    error_string = pprint.pformat(errors)
+
+    raise Exception(message_string.format(field, error_string))
 
 
 class UnicodeDictWriter(csv.DictWriter, object):
@@ -355,49 +456,721 @@ class UnicodeDictWriter(csv.DictWriter, object):
         for row in rows:
             self.writerow(row)
 
+    def writetuples(self, rows, encode=True):
+        """Write rows that are already tuples in fieldnames order, without building any dicts.
+
+        encode=False skips the unicode check for rows known to hold no unicode (e.g. numbers)."""
+        if encode:
+            rows = imap(_encode_row, rows)
+        self.writer.writerows(rows)
+
+
+def _encode_row(row):
+    """Return row with its unicode values utf-8 encoded (row itself if there are none)"""
+    for v in row:
+        if isinstance(v, unicode):
+            return [(v.encode('utf-8') if isinstance(v, unicode) else v) for v in row]
+    return row
+
+
+class CsvOutput(object):
+    """The csv files written by process_map, one UnicodeDictWriter per output table"""
+
+    def __init__(self, paths=OUTPUT_PATHS, header=True, compression=None, append=False):
+        if append and compression is not None:
+            raise ValueError("Compressed csv files can not be appended to")
+        self.compression = compression
+        self.append = append
+        self.files = [self._open(path) for path in paths]
+        self.writers = [UnicodeDictWriter(f, fields) for f, fields in zip(self.files, OUTPUT_FIELDS)]
+        if header and not append:
+            for writer in self.writers:
+                writer.writeheader()
+
+    def _open(self, path):
+        """Open one output; with compression ("gzip" or "zstd") its suffix is added to path.
+
+        With append=True existing files are opened for update, see truncate."""
+        if self.compression is not None:
+            suffix = compressed_io.OUTPUT_SUFFIXES.get(self.compression, '')
+            return compressed_io.CompressedWriter(path + suffix, self.compression)
+        # codecs.open defaults to line buffering, i.e. one write call per row
+        return codecs.open(path, 'r+b' if self.append else 'w', buffering=WRITE_BUFFER)
+
+    def add_table(self, table, path, fields):
+        """Open one more csv output (e.g. the way geometries) and return its writer"""
+        f = self._open(path)
+        self.files.append(f)
+        writer = UnicodeDictWriter(f, fields)
+        if not self.append:
+            writer.writeheader()
+        return writer
+
+    def sync(self):
+        """Flush the files to disk and return their sizes"""
+        sizes = []
+        for f in self.files:
+            f.flush()
+            os.fsync(f.fileno())
+            sizes.append(f.tell())
+        return sizes
+
+    def truncate(self, sizes):
+        """Cut the files opened with append=True back to sizes and continue writing from there"""
+        for f, size in zip(self.files, sizes):
+            f.truncate(size)
+            f.seek(size)
+
+    def load_csv(self, index, path):
+        """Append a headerless csv file (e.g. from a shard) to output number index"""
+        with open(path, 'rb') as csv_file:
+            shutil.copyfileobj(csv_file, self.files[index], SHARD_COPY_SIZE)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    abort = close
+
+
+def open_input(source, metrics=None, pipelined=False):
+    """Return source (a path or a file-like object) ready for iter_elements.
+
+    Paths ending in .bz2 or .gz are decompressed in a background thread. With pipelined=True
+    plain input is read ahead in a ThreadedReader too, and with metrics (a run_metrics.RunMetrics)
+    the bytes (as stored on disk) and time of the reads are counted in it. The result has a close
+    method unless it is source itself."""
+    compression = None if hasattr(source, 'read') else compressed_io.compression_of(source)
+    if not (pipelined or metrics is not None or compression):
+        return source
+    if not hasattr(source, 'read'):
+        source = open(source, 'rb')
+    if metrics is not None:
+        source = run_metrics.CountingReader(source, metrics)
+    if compression:
+        source = compressed_io.open_compressed(source, compression)
+    elif pipelined:
+        source = ThreadedReader(source)
+    return source
+
+
+def open_output(output='csv', db_path=DB_PATH, sqlite_options=None, compression=None,
+                columnar_dir=COLUMNAR_DIR, resume=False):
+    """Return the csv files, the SQLite database or the columnar tables that process_map writes to.
+
+    With resume=True the existing csv files or database are opened to be added to."""
+    if output == 'csv':
+        return CsvOutput(compression=compression, append=resume)
+    elif compression is not None:
+        raise ValueError("compression is for csv outputs")
+    elif output == 'sqlite':
+        return SQLiteSink(db_path, OUTPUT_TABLES, OUTPUT_FIELDS, overwrite=not resume,
+                          **(sqlite_options or {}))
+    elif output == 'columnar':
+        return columnar.ColumnarSink(columnar_dir, OUTPUT_TABLES, OUTPUT_FIELDS)
+    raise ValueError("Unknown output '{0}', expected one of {1}".format(output, OUTPUT_FORMATS))
+
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
+def make_validator(validator='compiled', schema=SCHEMA):
+    """Return the validator for validate_element: "compiled" or the original "cerberus" one"""
+    if validator == 'compiled':
+        return CompiledValidator(schema)
+    elif validator == 'cerberus':
+        if cerberus is None:
+            raise ImportError("validator='cerberus' needs the cerberus package")
+        return cerberus.Validator()
+    raise ValueError("Unknown validator '{0}', expected one of {1}".format(validator, VALIDATORS))
+
+
+def touches_cleaner(element):
+    """True if one of the element's tags goes through a cleaning function"""
+    for key, _ in element.tags:
+        if key in CLEANED_KEYS:
+            return True
+    return False
+
+
+def drop_reason(element):
+    """Return the tag key whose cleaner made shape_element drop element (e.g. "addr:postcode")"""
+    for key, value in element.tags:
+        cache = CLEANING_RULES.get(key)
+        # The cleaner itself, so that the cache statistics only count the calls of shape_element
+        if cache is not None and not PROBLEMCHARS.search(key) and cache.function(value) is None:
+            return key
+    return 'unknown'
+
+
+def write_elements(elements, writers, validate, counters=None, validate_every=1,
+                   validator='compiled', geometry=None, metrics=None):
+    """Shape each element and write it to the writers of the OUTPUT_TABLES (nodes, nodes_tags,
+    ways, ways_nodes, ways_tags, relations, relations_tags, relations_members).
+
+    If counters (an AuditCounters or StreamingAudit) is given, the raw tag values are audited on the way through.
+    With validate_every=N only every Nth element is validated, plus every element that has a tag
+    handled by one of the cleaning functions. Element types without an entry in the schema (e.g.
+    relations with the original schema.py) are not validated. If geometry (a node_index.WayGeometryWriter) is
+    given, every node location is indexed and a geometry row is written for each way.
+    If metrics (a run_metrics.RunMetrics) is given, the time of each stage and the elements in,
+    out and dropped are counted in it; otherwise run_metrics.NULL_METRICS takes its calls."""
+    timed = metrics is not None
+    if timed:
+        cleaner_stats = CLEANING_RULES.stats()
+        CLEANING_RULES.set_clock(metrics.clock)
+    else:
+        # Same calls, doing nothing: one loop serves both kinds of runs
+        metrics = run_metrics.NULL_METRICS
+    try:
+        _write_elements(elements, writers, validate, counters, validate_every, validator,
+                        geometry, metrics, timed)
+    finally:
+        if timed:
+            CLEANING_RULES.set_clock(None)
+    if timed:
+        metrics.add_cleaner_stats(cleaner_stats, CLEANING_RULES.stats())
+
+
+def _write_elements(elements, writers, validate, counters, validate_every, validator, geometry,
+                    metrics, timed):
+    (nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer,
+     relations_writer, relation_tags_writer, relation_members_writer) = writers
+
+    validator = make_validator(validator)
+    sample = 0
+    clock = metrics.clock
+    add_time = metrics.add_time
+
+    for element in elements:
+        tag = element.tag
+        metrics.element_in(tag)
+        if counters is not None:
+            start = clock()
+            counters.audit_element(element)
+            add_time('audit', clock() - start)
+        if geometry is not None and tag == 'node':
+            # Nodes dropped by the cleaning rules are still indexed, kept ways may use them
+            start = clock()
+            attrib = element.attrib
+            geometry.add_node(attrib['id'], attrib['lat'], attrib['lon'])
+            add_time('geometry', clock() - start)
+
+        start = clock()
+        el = shape_element(element, compact=True)
+        add_time('shape', clock() - start)
+        if not el:
+            if timed:
+                metrics.element_dropped(drop_reason(element))
+            continue
+        metrics.element_out(tag)
+
+        if validate is True and tag in SCHEMA:
+            sample += 1
+            if sample >= validate_every or touches_cleaner(element):
+                sample = 0
+                start = clock()
+                validate_compact(tag, el, validator)
+                add_time('validate', clock() - start)
+
+        start = clock()
+        if tag == 'node':
+            nodes_writer.writetuples((el['node'],))
+            node_tags_writer.writetuples(el['node_tags'])
+            add_time('write', clock() - start)
+            metrics.rows('nodes')
+            metrics.rows('nodes_tags', len(el['node_tags']))
+        elif tag == 'way':
+            ways_writer.writetuples((el['way'],))
+            way_nodes_writer.writetuples(way_node_rows(el['way'][0], el['way_nodes']),
+                                         encode=False)
+            way_tags_writer.writetuples(el['way_tags'])
+            add_time('write', clock() - start)
+            metrics.rows('ways')
+            metrics.rows('ways_nodes', len(el['way_nodes']))
+            metrics.rows('ways_tags', len(el['way_tags']))
+            if geometry is not None:
+                start = clock()
+                geometry.write_way(el['way'][0], el['way_nodes'])
+                add_time('geometry', clock() - start)
+                metrics.rows('ways_geometry')
+        elif tag == 'relation':
+            relations_writer.writetuples((el['relation'],))
+            relation_members_writer.writetuples(el['relation_members'].rows(el['relation'][0]))
+            relation_tags_writer.writetuples(el['relation_tags'])
+            add_time('write', clock() - start)
+            metrics.rows('relations')
+            metrics.rows('relations_members', len(el['relation_members']))
+            metrics.rows('relations_tags', len(el['relation_tags']))
+
+
+def process_map(file_in, validate, processes=1, shards=None, audit=False, parser=DEFAULT_PARSER,
+                output='csv', db_path=DB_PATH, sqlite_options=None, validate_every=1,
+                validator='compiled', geometry=False, node_index_dir=None, metrics=False,
+                progress_every=run_metrics.PROGRESS_SECONDS, profile=None, pipelined=False,
+                compression=None, area=None, columnar_dir=COLUMNAR_DIR, checkpoint=False,
+                checkpoint_every=CHECKPOINT_EVERY, resume=False, sorted_inputs=None):
+    """Iteratively process each XML element and write to csv(s)
+
+    file_in is an OSM file (also .bz2/.gz) or a list of overlapping extracts to merge (osm_merge,
+    sorted_inputs), read with the osm_parser backend named by parser. output is "csv"
+    (compression), "sqlite" (db_path, sqlite_options) or "columnar" (columnar_dir). processes > 1
+    splits the file into shards (process_map_parallel), pipelined=True overlaps reading and
+    writing in threads (process_map_serial). audit collects the audit of Data Audit.py on the way
+    and returns it (audit); validate, validate_every and validator check the rows against the
+    schema (write_elements). geometry adds ways_geometry (node_index), area keeps only what is
+    inside it (spatial_filter), checkpoint, checkpoint_every and resume make the run restartable
+    (checkpoint), metrics, progress_every and profile instrument it (run_metrics). Options that
+    do not go together raise ValueError."""
+    merged = isinstance(file_in, (list, tuple))
+    if merged and processes > 1:
+        raise ValueError("Merging several inputs needs processes=1")
+    if merged and checkpoint:
+        raise ValueError("checkpoint needs a single input file to record the offset in")
+    if geometry and processes > 1:
+        raise ValueError("geometry=True needs all nodes in one process, use processes=1")
+    if pipelined and processes > 1:
+        raise ValueError("pipelined=True is for processes=1, the worker processes of a parallel "
+                         "run already overlap their reads and writes")
+    if processes > 1 and compressed_io.compression_of(file_in):
+        raise ValueError("Compressed input can not be split into shards, use processes=1")
+    if area is not None and processes > 1:
+        raise ValueError("area needs the kept node ids of the whole file in one process, "
+                         "use processes=1")
+
+    if resume and not checkpoint:
+        raise ValueError("resume=True needs checkpoint")
+    if checkpoint:
+        check_checkpoint_options(file_in, processes, parser, output, compression, geometry, area)
+
+    counters = make_audit(audit)
+    write_options = dict(validate_every=validate_every, validator=validator)
+    checkpointer = state = None
+    if checkpoint:
+        checkpoint_path = CHECKPOINT_PATH if checkpoint is True else checkpoint
+        if resume and os.path.exists(checkpoint_path):
+            state, saved_counters = load_checkpoint(checkpoint_path, file_in, output)
+            if (saved_counters is None) != (counters is None):
+                raise ValueError("The checkpoint at '{0}' was taken with a different audit "
+                                 "option".format(checkpoint_path))
+            counters = saved_counters
+        if output == 'sqlite':
+            options = dict(journal_mode=UPDATE_JOURNAL_MODE, synchronous=UPDATE_SYNCHRONOUS)
+            options.update(sqlite_options or {})
+            sqlite_options = options
+    offset = state['offset'] if state else 0
+    input_size = sum(map(os.path.getsize, file_in)) if merged else os.path.getsize(file_in)
+    metrics = run_metrics.make_metrics(metrics, input_size - offset, progress_every)
+    merger = None
+    if merged:
+        # Made before the outputs are opened: it checks the order of the inputs
+        merger = make_merger(file_in, parser, sorted_inputs, metrics, pipelined)
+
+    sink = open_output(output, db_path, sqlite_options, compression, columnar_dir,
+                       resume=state is not None)
+    try:
+        if state:
+            sink.truncate(state['output_sizes'])
+        if checkpoint:
+            checkpointer = Checkpointer(checkpoint_path, file_in, output, sink,
+                                        every=checkpoint_every, counters=counters,
+                                        elements=state['elements'] if state else 0,
+                                        saved=state['checkpoints'] if state else 0)
+        if processes > 1:
+            process_map_parallel(file_in, validate, processes, shards, counters, parser, sink,
+                                 write_options, audit, metrics, profile)
+        else:
+            process_map_serial(file_in, validate, counters, parser, sink, write_options,
+                               geometry, node_index_dir, metrics, profile, pipelined, area,
+                               checkpointer, offset, merger)
+    except:
+        sink.abort()
+        raise
+    sink.close()
+    if checkpointer is not None:
+        checkpointer.remove()
+
+    if metrics is not None:
+        metrics.finish()
+        metrics.report_progress()
+        run_metrics.write_json(metrics, METRICS_PATH)
+    if isinstance(counters, StreamingAudit):
+        write_json(counters, AUDIT_JSON_PATH)
+    elif counters is not None:
+        write_report(counters, AUDIT_REPORT_PATH)
+    return counters
+
+
+def make_merger(paths, parser, sorted_inputs, metrics=None, pipelined=False):
+    """Return the osm_merge.ExtractMerger of paths, spilling its runs next to the outputs"""
+    return ExtractMerger(paths, parser, ELEMENT_TYPES,
+                         work_dir=os.path.dirname(os.path.abspath(NODES_PATH)),
+                         sorted_inputs=sorted_inputs,
+                         opener=partial(open_input, metrics=metrics, pipelined=pipelined))
+
+
+def check_checkpoint_options(file_in, processes, parser, output, compression, geometry, area):
+    """Raise ValueError for process_map options a checkpointed run does not support"""
+    if processes > 1:
+        raise ValueError("checkpoint is for processes=1, a parallel run restarts its shards")
+    if parser != 'expat':
+        raise ValueError("checkpoint needs the byte offsets of the expat parser")
+    if compressed_io.compression_of(file_in):
+        raise ValueError("A checkpointed run can not restart in the middle of compressed input")
+    if output not in ('csv', 'sqlite') or compression is not None:
+        raise ValueError("checkpoint needs uncompressed csv or sqlite output, other outputs "
+                         "can not be cut back to a checkpoint")
+    if geometry or area is not None:
+        raise ValueError("geometry and area keep state about the earlier elements that is not "
+                         "checkpointed")
+
+
+def process_map_serial(file_in, validate, counters, parser, sink, write_options, geometry=False,
+                       node_index_dir=None, metrics=None, profile=None, pipelined=False,
+                       area=None, checkpointer=None, offset=0, merger=None):
+    """Process file_in in this process, writing to sink (a CsvOutput or SQLiteSink).
+
+    With pipelined=True the input is read in large chunks by a ThreadedReader and each csv output
+    is written in batches by its own ThreadedWriter, so that reading, parsing and shaping, and
+    writing overlap. SQLite outputs are still written by this thread: an SQLite connection can
+    only be used by the thread that opened it.
+    With area, the elements go through a spatial_filter.SpatialFilter straight after parsing.
+    With a checkpoint.Checkpointer the checkpoints are taken between two elements; a resumed run
+    starts parsing at offset. If file_in is a list of paths, their elements are merged by merger
+    (an osm_merge.ExtractMerger, made by make_merger if not given)."""
+    threaded_writers = pipelined and isinstance(sink, CsvOutput)
+    writers = sink.writers[:len(OUTPUT_TABLES)]
+    write_options = dict(write_options)
+    index_dir = None
+    if geometry:
+        geometry_writer = sink.add_table('ways_geometry', WAY_GEOMETRY_PATH, WAY_GEOMETRY_FIELDS)
+        writers.append(geometry_writer)
+        index_dir = node_index_dir or tempfile.mkdtemp(
+            prefix='osm_node_index_', dir=os.path.dirname(os.path.abspath(NODES_PATH)))
+    if threaded_writers:
+        writers = [ThreadedWriter(writer) for writer in writers]
+    if geometry:
+        write_options['geometry'] = WayGeometryWriter(writers.pop(), index_dir)
+
+    if isinstance(file_in, (list, tuple)):
+        if merger is None:
+            merger = make_merger(file_in, parser, None, metrics, pipelined)
+        input_file = file_in
+    else:
+        source = file_in
+        if offset:
+            source = osm_shards.remainder(file_in, offset)
+            checkpointer.base_offset = source.base_offset
+        input_file = open_input(source, metrics, pipelined)
+    try:
+        if merger is not None:
+            elements = merger.elements()
+        else:
+            elements = iter_elements(input_file, tags=ELEMENT_TYPES, parser=parser)
+        if metrics is not None:
+            elements = run_metrics.timed_iter(elements, metrics, 'parse')
+            write_options['metrics'] = metrics
+        spatial_filter = None
+        if area is not None:
+            spatial_filter = SpatialFilter(area)
+            elements = spatial_filter.filter(elements)
+            if metrics is not None:
+                elements = run_metrics.timed_iter(elements, metrics, 'area')
+        if checkpointer is not None:
+            if threaded_writers:
+                checkpointer.writers = writers
+            elements = checkpointer.track(elements)
+        if profile:
+            run_metrics.profiled(write_elements, profile, elements, writers, validate, counters,
+                                 **write_options)
+        else:
+            write_elements(elements, writers, validate, counters, **write_options)
+        if merger is not None and metrics is not None:
+            metrics.add_filtered('duplicate', merger.duplicates)
+        if spatial_filter is not None and metrics is not None:
+            metrics.add_filtered('outside area', spatial_filter.dropped)
+        if geometry:
+            write_options['geometry'].close()
+        if threaded_writers:
+            for writer in writers:
+                writer.close()
+            if geometry:
+                write_options['geometry'].writer.close()
+    except:
+        if threaded_writers:
+            for writer in writers:
+                writer.abort()
+            if geometry:
+                write_options['geometry'].writer.abort()
+        raise
+    finally:
+        if input_file is not file_in:
+            input_file.close()
+        if merger is not None:
+            merger.close()
+        if index_dir is not None and node_index_dir is None:
+            shutil.rmtree(index_dir, ignore_errors=True)
+
+
+# ================================================== #
+#               Parallel Processing                  #
+# ================================================== #
+def process_shard(task):
+    """Shape one byte-range shard of the input into headerless csv files inside shard_dir"""
+    (file_in, start, end, shard_dir, parser, audit, validate, write_options, metrics,
+     profile) = task
+
+    counters = make_audit(audit)
+    # Progress is reported by the parent process as the shards come back
+    metrics = run_metrics.RunMetrics(progress_every=None, stream=None) if metrics else None
+    paths = [os.path.join(shard_dir, os.path.basename(path)) for path in OUTPUT_PATHS]
+    shard_output = CsvOutput(paths, header=False)
+    try:
+        with osm_shards.ShardReader(file_in, start, end) as reader:
+            elements = iter_elements(open_input(reader, metrics), tags=ELEMENT_TYPES,
+                                     parser=parser)
+            if metrics is not None:
+                elements = run_metrics.timed_iter(elements, metrics, 'parse')
+                write_options = dict(write_options, metrics=metrics)
+            if profile:
+                run_metrics.profiled(write_elements, profile, elements, shard_output.writers,
+                                     validate, counters, **write_options)
+            else:
+                write_elements(elements, shard_output.writers, validate, counters,
+                               **write_options)
+    finally:
+        shard_output.close()
+    if metrics is not None:
+        metrics.finish()
+    return paths, counters, metrics
+
+
+def process_map_parallel(file_in, validate, processes, shards=None, counters=None,
+                         parser=DEFAULT_PARSER, sink=None, write_options=None, audit=False,
+                         metrics=None, profile=None):
+    """Process byte-range shards of file_in in a pool of worker processes.
+
+    Each worker writes its own set of csv files; they are appended to sink (a CsvOutput or
+    SQLiteSink, by default the csv outputs) in shard order, so the result is identical to a
+    serial run. Using more shards than processes keeps the workers busy when some parts of the
+    file are denser than others. Each worker collects its own audit of the kind given by audit,
+    which is merged into counters, and write_options are passed on to write_elements in each worker.
+    Likewise each worker fills its own RunMetrics if metrics is given, which is merged into it, and
+    with profile=PATH each worker dumps its cProfile stats to PATH.<shard>."""
+    ranges = osm_shards.find_shards(file_in, shards or processes)
+
+    output_dir = os.path.dirname(os.path.abspath(NODES_PATH))
+    work_dir = tempfile.mkdtemp(prefix='osm_shards_', dir=output_dir)
+    tasks = []
+    for i, (start, end) in enumerate(ranges):
+        shard_dir = os.path.join(work_dir, str(i))
+        os.mkdir(shard_dir)
+        shard_profile = '{0}.{1}'.format(profile, i) if profile else None
+        tasks.append((file_in, start, end, shard_dir, parser, audit, validate, write_options or {},
+                      metrics is not None, shard_profile))
+
+    own_sink = sink is None
+    if own_sink:
+        sink = CsvOutput()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        # imap hands back the shards in order, so each one can be merged as soon as it is done
+        for shard_paths, shard_counters, shard_metrics in pool.imap(process_shard, tasks):
+            for index, path in enumerate(shard_paths):
+                sink.load_csv(index, path)
+                os.remove(path)
+            if counters is not None:
+                counters.merge(shard_counters)
+            if metrics is not None:
+                metrics.merge(shard_metrics)
+                metrics.maybe_report()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if own_sink:
+            sink.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# ================================================== #
+#               Incremental Updates                  #
+# ================================================== #
+def read_changes(change_file, validate=True, validator='compiled'):
+    """Shape the elements of an osmChange file with the same cleaning as process_map.
+
+    Returns {(tag, id): (version, el)} with the newest change of each element, where el is the
+    element shaped with compact=True, or None if it is deleted or dropped by the cleaning rules."""
+    validator = make_validator(validator) if validate is True else None
+    changes = {}
+    for action, element in iter_changes(change_file, tags=ELEMENT_TYPES):
+        key = (element.tag, int(element.attrib['id']))
+        version = int(element.attrib.get('version', 0))
+        previous = changes.get(key)
+        if previous is not None and previous[0] > version:
+            continue
+        el = None
+        if action != 'delete':
+            el = shape_element(element, compact=True)
+            if el and validator is not None and element.tag in SCHEMA:
+                validate_compact(element.tag, el, validator)
+        changes[key] = (version, el)
+    return changes
+
+
+def element_rows(tag, el):
+    """Return the rows of a compact shaped element for each of its ELEMENT_TABLES"""
+    if tag == 'node':
+        return [(el['node'],), el['node_tags']]
+    elif tag == 'relation':
+        return [(el['relation'],), el['relation_tags'],
+                el['relation_members'].rows(el['relation'][0])]
+    return [(el['way'],), way_node_rows(el['way'][0], el['way_nodes']), el['way_tags']]
+
+
+def changed_ids(changes, tag):
+    return set(element_id for element_tag, element_id in changes if element_tag == tag)
+
+
+def drop_stale_changes(changes, stored_versions):
+    """Remove the changes older than the version already in the outputs and return their number.
+
+    stored_versions maps (tag, id) to the version in the outputs."""
+    stale = [key for key, (version, _) in changes.iteritems()
+             if key in stored_versions and int(stored_versions[key]) > version]
+    for key in stale:
+        del changes[key]
+    return len(stale)
+
+
+def apply_changes(change_file, validate=True, output='csv', db_path=DB_PATH, sqlite_options=None,
+                  validator='compiled'):
+    """Update the outputs of an earlier process_map run with an osmChange (.osc) file.
+
+    The created and modified elements go through shape_element like in a full run and replace
+    the rows with the same id; deleted elements, and elements the cleaning rules now drop, have
+    their rows removed. Changes older than the version already in the outputs are skipped, so
+    applying the same file twice is harmless. The csv files are rewritten in one streaming pass
+    each; an SQLite database is updated in place in a single transaction.
+    Way geometries (geometry=True) are not recomputed: the geometry rows of the changed ways, and
+    of the ways using a changed node, are removed, and a full run writes them again.
+
+    Returns {"upserted": n, "removed": n, "stale": n}."""
+    changes = read_changes(change_file, validate, validator)
+    if output == 'csv':
+        stale = apply_changes_csv(changes)
+    elif output == 'sqlite':
+        stale = apply_changes_sqlite(changes, db_path, sqlite_options)
+    else:
+        raise ValueError("Unknown output '{0}', expected 'csv' or 'sqlite'".format(output))
+    upserted = sum(1 for _, el in changes.itervalues() if el)
+    return {'upserted': upserted, 'removed': len(changes) - upserted, 'stale': stale}
+
+
+def apply_changes_sqlite(changes, db_path=DB_PATH, sqlite_options=None):
+    """Apply the changes of read_changes to the SQLite database at db_path"""
+    if not os.path.exists(db_path):
+        raise IOError("No database at '{0}' to apply the changes to".format(db_path))
+    options = dict(journal_mode=UPDATE_JOURNAL_MODE, synchronous=UPDATE_SYNCHRONOUS)
+    options.update(sqlite_options or {})
+    sink = SQLiteSink(db_path, OUTPUT_TABLES, OUTPUT_FIELDS, overwrite=False, **options)
+    try:
+        # The lookups and deletes go by id
+        sink.create_indexes()
+        stored_versions = {}
+        for tag, tables in ELEMENT_TABLES.items():
+            versions = sink.versions(OUTPUT_TABLES[tables[0]], changed_ids(changes, tag))
+            for element_id, version in versions.iteritems():
+                stored_versions[(tag, element_id)] = version
+        stale = drop_stale_changes(changes, stored_versions)
+
+        if sink.has_table('ways_geometry'):
+            node_ways = sink.referencing_ids('ways_nodes', 'node_id', changed_ids(changes, 'node'))
+            sink.delete('ways_geometry', changed_ids(changes, 'way') | node_ways)
+        for tag, tables in ELEMENT_TABLES.items():
+            ids = changed_ids(changes, tag)
+            for index in tables:
+                sink.delete(OUTPUT_TABLES[index], ids)
+        for (tag, _), (_, el) in sorted(changes.iteritems()):
             if el:
-                if validate is True:
-                    validate_element(el, validator)
+                for index, rows in zip(ELEMENT_TABLES[tag], element_rows(tag, el)):
+                    sink.writers[index].writetuples(rows)
+    except:
+        sink.abort()
+        raise
+    sink.close()
+    return stale
+
+
+def apply_changes_csv(changes, paths=OUTPUT_PATHS, geometry_path=WAY_GEOMETRY_PATH):
+    """Apply the changes of read_changes to the csv outputs at paths, removing the stale rows of
+    the way geometries at geometry_path if there are any"""
+    stored_versions = {}
+    for tag, tables in ELEMENT_TABLES.items():
+        ids = changed_ids(changes, tag)
+        with open(paths[tables[0]], 'rb') as csv_file:
+            reader = csv.reader(csv_file)
+            version_column = next(reader).index('version')
+            for row in reader:
+                element_id = int(row[0])
+                if element_id in ids:
+                    stored_versions[(tag, element_id)] = row[version_column]
+    stale = drop_stale_changes(changes, stored_versions)
+
+    if os.path.exists(geometry_path):
+        # Read before ways_nodes is rewritten: the ways using a changed node before the change
+        node_ways = ways_using_nodes(paths[OUTPUT_TABLES.index('ways_nodes')],
+                                     changed_ids(changes, 'node'))
+        rewrite_csv(geometry_path, WAY_GEOMETRY_FIELDS, changed_ids(changes, 'way') | node_ways,
+                    [])
+    for tag, tables in ELEMENT_TABLES.items():
+        ids = changed_ids(changes, tag)
+        shaped = [el for (element_tag, _), (_, el) in sorted(changes.iteritems())
+                  if element_tag == tag and el]
+        for position, index in enumerate(tables):
+            new_rows = [element_rows(tag, el)[position] for el in shaped]
+            rewrite_csv(paths[index], OUTPUT_FIELDS[index], ids, new_rows)
+    return stale
+
+
+def ways_using_nodes(ways_nodes_path, node_ids):
+    """Return the set of ids of the ways in the ways_nodes csv file that use one of node_ids"""
+    way_ids = set()
+    if not node_ids:
+        return way_ids
+    with open(ways_nodes_path, 'rb') as csv_file:
+        reader = csv.reader(csv_file)
+        node_column = next(reader).index('node_id')
+        for row in reader:
+            if int(row[node_column]) in node_ids:
+                way_ids.add(int(row[0]))
+    return way_ids
+
 
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+def rewrite_csv(path, fields, removed_ids, new_rows):
+    """Copy the csv file at path without the rows of removed_ids, add new_rows (a list of lists of
+    row tuples) at the end and put the copy in its place"""
+    fd, new_path = tempfile.mkstemp(prefix='.', suffix='.csv',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with open(path, 'rb') as old_file, os.fdopen(fd, 'wb', WRITE_BUFFER) as new_file:
+            reader = csv.reader(old_file)
+            writer = UnicodeDictWriter(new_file, fields)
+            writer.writer.writerow(next(reader))
+            writer.writetuples((row for row in reader if int(row[0]) not in removed_ids),
+                               encode=False)
+            for rows in new_rows:
+                writer.writetuples(rows)
+        os.rename(new_path, path)
+    except:
+        os.remove(new_path)
+        raise
 
 
 if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
+    # Note: Validation with validator='cerberus' is ~ 10X slower. The compiled validator is cheap
+    # enough to check the whole map; validate_every=N checks only a sample of it.
     process_map(OSM_PATH, validate=True)
\ No newline at end of file
@@ -0,0 +1,253 @@
+"""Audit counters for street, postcode, phone and city values.
+
+Used on its own by Data Audit.py and alongside shaping by process_map(audit=True), so that a single
+pass over the OSM file both cleans the data and reports what was found in it.
+
+AuditCounters keeps exact counts of every value. StreamingAudit (audit="streaming") keeps
+fixed-size sketches instead, so its memory does not grow with the size of the input, and exports
+its results as JSON."""
+import codecs
+import json
+import re
+import sys
+from collections import defaultdict
+
+from audit_sketches import CountMinSketch, HyperLogLog, Reservoir, SpaceSaving, hash128
+
+street_regex=re.compile(r'\S+$')
+postcode_regex=re.compile(r'\S+$')
+cityname_regex=re.compile(r'\S+\s*\S*')
+
+STREET_KEY = "addr:street"
+POSTCODE_KEY = "addr:postcode"
+PHONE_KEY = "phone"
+CITY_KEY = "addr:city"
+
+AUDIT_MODES = (False, True, 'exact', 'streaming')
+POSTCODE_FORMAT = re.compile(r'^\d{5}(-\d{4})?$')
+NON_DIGITS = re.compile(r'\D+')
+
+""" Function will return all different types of streetnames and the number of times they occur"""
+def audit_street_names(street_name,street_group_count):
+    m=street_regex.search(street_name)
+    if m:
+        street_type=m.group()
+        street_group_count[street_type] +=1
+
+""" Function will return all zipcodes and the number of items each zipcode occurs"""
+def audit_postcode(postcode,postcode_count):
+    m=postcode_regex.search(postcode)
+    if m:
+        postcode_type=m.group()
+        postcode_count[postcode_type] +=1
+
+"""Function will return all city names in the data and the number of times each city name occurs"""
+def audit_cityname(cityname,city_count):
+    m=cityname_regex.search(cityname)
+    if m:
+        city_type=m.group()
+        city_count[city_type]+=1
+
+"""Function will return all phone numbers in the data"""
+def audit_phone(phoneNumber,phonelist):
+    phonelist.append(phoneNumber)
+
+
+class AuditCounters(object):
+    """Street, postcode and city counts plus the list of phone numbers seen in the data"""
+
+    def __init__(self):
+        self.street_group_count = defaultdict(int)
+        self.postcode_count = defaultdict(int)
+        self.city_count = defaultdict(int)
+        self.phonelist = []
+
+    def audit_tag(self, key, value):
+        """Count one secondary tag value if it belongs to an audited key"""
+        if key == STREET_KEY:
+            audit_street_names(value, self.street_group_count)
+        elif key == POSTCODE_KEY:
+            audit_postcode(value, self.postcode_count)
+        elif key == PHONE_KEY:
+            audit_phone(value, self.phonelist)
+        elif key == CITY_KEY:
+            audit_cityname(value, self.city_count)
+
+    def audit_element(self, element):
+        """Audit every secondary tag of a node, way or relation OsmElement"""
+        for key, value in element.tags:
+            self.audit_tag(key, value)
+
+    def merge(self, other):
+        """Add the counts of another AuditCounters (e.g. from a worker process) to this one"""
+        for mine, theirs in ((self.street_group_count, other.street_group_count),
+                             (self.postcode_count, other.postcode_count),
+                             (self.city_count, other.city_count)):
+            for value, count in theirs.iteritems():
+                mine[value] += count
+        self.phonelist.extend(other.phonelist)
+
+    def to_dict(self):
+        """Return the counts as a JSON-serializable dict"""
+        return {"street_types": dict(self.street_group_count),
+                "postcodes": dict(self.postcode_count),
+                "cities": dict(self.city_count),
+                "phones": list(self.phonelist)}
+
+    def report_lines(self):
+        """Yield the lines of the audit report"""
+        # Sorted so that the report does not depend on the order in which shards were merged
+        sections = (("Street name and count", sorted(self.street_group_count.items())),
+                    ("Postcode and count", sorted(self.postcode_count.items())),
+                    ("City and Count", sorted(self.city_count.items())))
+        for title, items in sections:
+            yield ""
+            yield title
+            yield "******************************************"
+            for value, count in items:
+                yield "%s \t %s" % (value, count)
+
+        yield ""
+        yield "Phone list"
+        yield "******************************************"
+        for phone in self.phonelist:
+            yield phone
+
+
+def write_report(counters, path):
+    """Write the audit report of counters to a utf-8 text file"""
+    with codecs.open(path, 'w', encoding='utf-8') as report_file:
+        for line in counters.report_lines():
+            if isinstance(line, str):
+                line = line.decode('utf-8')
+            report_file.write(line)
+            report_file.write(u"\n")
+
+
+def write_json(counters, path=None):
+    """Write counters.to_dict() (AuditCounters or StreamingAudit) as JSON to path, or to stdout"""
+    if path is None:
+        json.dump(counters.to_dict(), sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    with open(path, 'w') as json_file:
+        json.dump(counters.to_dict(), json_file, indent=2, sort_keys=True)
+
+
+def is_malformed_phone(phoneNumber):
+    """True unless the number is 10 digits, optionally after a leading 1 country code"""
+    digits = NON_DIGITS.sub("", phoneNumber)
+    if len(digits) == 11 and digits.startswith("1"):
+        digits = digits[1:]
+    return len(digits) != 10
+
+
+def is_malformed_postcode(postcode):
+    """True unless the postcode is a 5 digit zip code, optionally followed by -4 digits"""
+    return POSTCODE_FORMAT.match(postcode) is None
+
+
+class ValueSummary(object):
+    """Fixed-size summary of one audited category: total, distinct estimate and top-k values,
+    plus a sample of the malformed values with the count-min estimate of how often each of them
+    was seen if is_malformed is given"""
+
+    def __init__(self, top_k=50, precision=14, sample_size=100, is_malformed=None):
+        self.total = 0
+        self.distinct = HyperLogLog(precision)
+        self.frequencies = CountMinSketch()
+        self.top = SpaceSaving(top_k)
+        self.is_malformed = is_malformed
+        self.malformed = 0
+        self.malformed_sample = Reservoir(sample_size)
+
+    def add(self, value):
+        self.total += 1
+        hashes = hash128(value)
+        self.distinct.add(value, hashes)
+        self.frequencies.add(value, hashes=hashes)
+        self.top.add(value)
+        if self.is_malformed is not None and self.is_malformed(value):
+            self.malformed += 1
+            self.malformed_sample.add(value)
+
+    def estimate(self, value):
+        """Estimated number of times value was seen (never too low)"""
+        return self.frequencies.estimate(value)
+
+    def merge(self, other):
+        self.total += other.total
+        self.distinct.merge(other.distinct)
+        self.frequencies.merge(other.frequencies)
+        self.top.merge(other.top)
+        self.malformed += other.malformed
+        self.malformed_sample.merge(other.malformed_sample)
+
+    def to_dict(self):
+        summary = {"total": self.total,
+                   "distinct_estimate": self.distinct.count(),
+                   "top": [{"value": value, "count": count, "max_error": error}
+                           for value, count, error in self.top.top()]}
+        if self.is_malformed is not None:
+            summary["malformed"] = self.malformed
+            summary["malformed_sample"] = self.malformed_sample.sample
+            # A value rarer than the top-k ones is only counted by the count-min sketch
+            summary["malformed_estimates"] = dict((value, self.estimate(value))
+                                                  for value in self.malformed_sample.sample)
+        return summary
+
+
+class StreamingAudit(object):
+    """Bounded-memory counterpart of AuditCounters for inputs too big to count exactly"""
+
+    def __init__(self, top_k=50, precision=14, sample_size=100):
+        options = dict(top_k=top_k, precision=precision, sample_size=sample_size)
+        self.street_types = ValueSummary(**options)
+        self.postcodes = ValueSummary(is_malformed=is_malformed_postcode, **options)
+        self.cities = ValueSummary(**options)
+        self.phones = ValueSummary(is_malformed=is_malformed_phone, **options)
+
+    def audit_tag(self, key, value):
+        """Summarize one secondary tag value if it belongs to an audited key"""
+        if key == STREET_KEY:
+            m = street_regex.search(value)
+            if m:
+                self.street_types.add(m.group())
+        elif key == POSTCODE_KEY:
+            m = postcode_regex.search(value)
+            if m:
+                self.postcodes.add(m.group())
+        elif key == PHONE_KEY:
+            self.phones.add(value)
+        elif key == CITY_KEY:
+            m = cityname_regex.search(value)
+            if m:
+                self.cities.add(m.group())
+
+    def audit_element(self, element):
+        """Audit every secondary tag of a node, way or relation OsmElement"""
+        for key, value in element.tags:
+            self.audit_tag(key, value)
+
+    def merge(self, other):
+        self.street_types.merge(other.street_types)
+        self.postcodes.merge(other.postcodes)
+        self.cities.merge(other.cities)
+        self.phones.merge(other.phones)
+
+    def to_dict(self):
+        return {"street_types": self.street_types.to_dict(),
+                "postcodes": self.postcodes.to_dict(),
+                "cities": self.cities.to_dict(),
+                "phones": self.phones.to_dict()}
+
+
+def make_audit(audit):
+    """Return the collector for process_map's audit option: None, AuditCounters or StreamingAudit"""
+    if audit not in AUDIT_MODES:
+        raise ValueError("Unknown audit '{0}', expected one of {1}".format(audit, AUDIT_MODES))
+    if audit == 'streaming':
+        return StreamingAudit()
+    elif audit:
+        return AuditCounters()
+    return None
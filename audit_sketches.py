@@ -0,0 +1,203 @@
+"""
+Fixed-size summaries of value streams, used by the streaming audit.
+
+All of them use memory that does not depend on how many (distinct) values go through them, and
+all of them can be merged, so the summaries of several shards can be combined into one.
+
+- HyperLogLog: estimate of the number of distinct values
+- CountMinSketch: estimate of how often a given value occurred (never too low)
+- SpaceSaving: the k most frequent values with their counts and maximum overestimation
+- Reservoir: a uniform random sample of the values
+"""
+from array import array
+import hashlib
+import heapq
+import math
+import random
+import struct
+
+HASH = struct.Struct('<QQ')
+
+
+def hash128(value):
+    """Return two independent 64-bit hashes of a str or unicode value"""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return HASH.unpack(hashlib.md5(value).digest())
+
+
+class HyperLogLog(object):
+    """Distinct count estimate with a relative error of about 1.04 / sqrt(2 ** precision)"""
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    def add(self, value, hashes=None):
+        h = (hashes or hash128(value))[0]
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        # Position of the leftmost 1 bit in the remaining 64 - precision bits
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction: linear counting
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        registers = self.registers
+        for i, r in enumerate(other.registers):
+            if r > registers[i]:
+                registers[i] = r
+
+
+class CountMinSketch(object):
+    """Frequency estimates that are at most total / width * e too high with high probability"""
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.tables = [array('l', [0]) * width for _ in range(depth)]
+        self.total = 0
+
+    def _columns(self, hashes):
+        h1, h2 = hashes
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def add(self, value, count=1, hashes=None):
+        """Count value and return its new estimate"""
+        estimate = None
+        for table, column in zip(self.tables, self._columns(hashes or hash128(value))):
+            table[column] += count
+            if estimate is None or table[column] < estimate:
+                estimate = table[column]
+        self.total += count
+        return estimate
+
+    def estimate(self, value, hashes=None):
+        return min(table[column] for table, column
+                   in zip(self.tables, self._columns(hashes or hash128(value))))
+
+    def merge(self, other):
+        for table, other_table in zip(self.tables, other.tables):
+            for i, count in enumerate(other_table):
+                table[i] += count
+        self.total += other.total
+
+
+class SpaceSaving(object):
+    """Top-k frequent values (Metwally et al.): every value counted more than total / k times is
+    kept, and each count is at most its error too high"""
+
+    def __init__(self, k=50):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        # (count, value) entries, some of them stale; the smallest current one is the eviction target
+        self._heap = []
+
+    def add(self, value, count=1):
+        counts = self.counts
+        if value in counts:
+            counts[value] += count
+            heapq.heappush(self._heap, (counts[value], value))
+        elif len(counts) < self.k:
+            counts[value] = count
+            self.errors[value] = 0
+            heapq.heappush(self._heap, (count, value))
+        else:
+            smallest, evicted = self._pop_min()
+            del counts[evicted]
+            del self.errors[evicted]
+            counts[value] = smallest + count
+            self.errors[value] = smallest
+            heapq.heappush(self._heap, (counts[value], value))
+        if len(self._heap) > 8 * self.k:
+            self._heap = [(c, v) for v, c in counts.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, value = heapq.heappop(self._heap)
+            if self.counts.get(value) == count:
+                return count, value
+
+    def top(self):
+        """Return [(value, count, error)] sorted by decreasing count"""
+        return sorted(((value, count, self.errors[value]) for value, count in self.counts.iteritems()),
+                      key=lambda item: (-item[1], item[0]))
+
+    def _floor(self):
+        """The count any value missing from a full summary may have had, else 0"""
+        return min(self.counts.itervalues()) if len(self.counts) >= self.k else 0
+
+    def merge(self, other):
+        """Combine two summaries, keeping the k largest of the summed counts (Agarwal et al.):
+        a value missing from a full summary may have been counted up to that summary's smallest
+        count there, so that count is added to its count and its error"""
+        self_min, other_min = self._floor(), other._floor()
+        combined = {}
+        errors = {}
+        for value, count in self.counts.iteritems():
+            if value in other.counts:
+                combined[value] = count + other.counts[value]
+                errors[value] = self.errors[value] + other.errors[value]
+            else:
+                combined[value] = count + other_min
+                errors[value] = self.errors[value] + other_min
+        for value, count in other.counts.iteritems():
+            if value not in combined:
+                combined[value] = count + self_min
+                errors[value] = other.errors[value] + self_min
+        kept = heapq.nlargest(self.k, combined.iteritems(), key=lambda item: item[1])
+        self.counts = dict(kept)
+        self.errors = dict((value, errors[value]) for value, _ in kept)
+        self._heap = [(c, v) for v, c in self.counts.iteritems()]
+        heapq.heapify(self._heap)
+
+
+class Reservoir(object):
+    """Uniform random sample of at most size values (algorithm R)"""
+
+    def __init__(self, size=100, seed=None):
+        self.size = size
+        self.seen = 0
+        self.sample = []
+        self.random = random.Random(seed)
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+        else:
+            i = self.random.randrange(self.seen)
+            if i < self.size:
+                self.sample[i] = value
+
+    def merge(self, other):
+        """Combine two reservoirs, drawing from each in proportion to how many values it saw"""
+        seen = self.seen + other.seen
+        if seen == 0:
+            return
+        mine, theirs = list(self.sample), list(other.sample)
+        self.random.shuffle(mine)
+        self.random.shuffle(theirs)
+        sample = []
+        while len(sample) < self.size and (mine or theirs):
+            pick_mine = self.random.random() * seen < self.seen
+            if (pick_mine and mine) or not theirs:
+                sample.append(mine.pop())
+            else:
+                sample.append(theirs.pop())
+        self.sample = sample
+        self.seen = seen
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the cleaning pipeline on synthetic OSM files of any size.
+
+The synthetic files copy what sample.osm looks like: the share of tagged nodes, the tags and
+values themselves (addr:* tags, phone numbers, ...), the number of nodes per way (including the
+long ones) and the users. Nodes come first with increasing ids, then the ways that reference them,
+like in a real extract.
+
+Each stage runs in its own forked process so that its peak RSS can be measured on its own:
+
+- parse:       osm_parser.iter_elements with each available parser backend
+- shape:       shape_element (compact, like process_map uses it)
+- cleaners:    the CLEANING_RULES cleaners on the values of their tags (items/sec only)
+- validate:    validate_element with the compiled validator (and cerberus with --cerberus)
+- write:       the csv writers
+- process_map: the whole pipeline, end to end
+
+Usage:
+    python benchmark.py --sizes 10MB,100MB,1GB [--stages parse,process_map] [--json results.json]
+"""
+import argparse
+import imp
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import quoteattr
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import osm_parser
+
+SAMPLE_PATH = os.path.join(HERE, "sample.osm")
+STAGES = ['parse', 'shape', 'cleaners', 'validate', 'write', 'process_map']
+# Stages that time the work on a few tag values only, so the input size per second means nothing
+NO_MB_RATE = frozenset(['cleaners'])
+SIZE_UNITS = {'KB': 1 << 10, 'MB': 1 << 20, 'GB': 1 << 30}
+
+
+def load_cleaning():
+    """Import Data Cleaning.py, whose file name is not a valid module name"""
+    return imp.load_source('data_cleaning', os.path.join(HERE, 'Data Cleaning.py'))
+
+
+def parse_size(text):
+    """Turn "10MB", "2GB" or a plain number of bytes into a number of bytes"""
+    text = text.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+# ================================================== #
+#               Synthetic OSM Generator              #
+# ================================================== #
+class TagProfile(object):
+    """What the elements of an OSM file look like, collected from a real (sample) file"""
+
+    def __init__(self):
+        self.node_tag_sets = []
+        self.untagged_nodes = 0
+        self.way_tag_sets = []
+        self.way_lengths = []
+        self.users = []
+        self.nodes = 0
+        self.ways = 0
+
+    @classmethod
+    def from_osm(cls, osm_path=SAMPLE_PATH):
+        profile = cls()
+        users = set()
+        for element in osm_parser.iter_elements(osm_path, tags=('node', 'way')):
+            users.add((element.attrib['user'], element.attrib['uid']))
+            if element.tag == 'node':
+                profile.nodes += 1
+                if element.tags:
+                    profile.node_tag_sets.append(element.tags)
+                else:
+                    profile.untagged_nodes += 1
+            else:
+                profile.ways += 1
+                profile.way_tag_sets.append(element.tags)
+                profile.way_lengths.append(max(2, len(element.refs)))
+        profile.users = sorted(users)
+        return profile
+
+    def tagged_node_share(self):
+        return float(len(self.node_tag_sets)) / max(1, self.nodes)
+
+    def node_share(self):
+        return float(self.nodes) / max(1, self.nodes + self.ways)
+
+
+def _tag_lines(tags):
+    return ''.join('\t\t<tag k={0} v={1} />\n'.format(quoteattr(k), quoteattr(v)) for k, v in tags)
+
+
+def generate_osm(path, size, profile=None, seed=0):
+    """Write a synthetic OSM file of about size bytes to path and return the element counts"""
+    profile = profile or TagProfile.from_osm()
+    rng = random.Random(seed)
+    tagged_share = profile.tagged_node_share()
+    node_share = profile.node_share()
+
+    # Nodes take most of the bytes; stop writing nodes once their share of the target is reached
+    # and fill the rest with ways over those nodes
+    average_way_length = sum(profile.way_lengths) / float(len(profile.way_lengths))
+    node_bytes_share = node_share / (node_share + (1 - node_share) * average_way_length / 4.0)
+    node_bytes = int(size * node_bytes_share)
+
+    counts = {'node': 0, 'way': 0}
+    first_node_id = 1000000
+    first_way_id = 100000
+    timestamp = '2017-06-14T20:34:14Z'
+    with open(path, 'wb') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+        node_id = first_node_id
+        while f.tell() < node_bytes:
+            user, uid = rng.choice(profile.users)
+            lat = 37.1 + rng.random() * 0.4
+            lon = -122.1 + rng.random() * 0.5
+            attributes = 'changeset="{0}" id="{1}" lat="{2:.7f}" lon="{3:.7f}" timestamp="{4}" ' \
+                         'uid="{5}" user={6} version="{7}"'.format(
+                             rng.randint(1000000, 50000000), node_id, lat, lon, timestamp, uid,
+                             quoteattr(user), rng.randint(1, 20))
+            if rng.random() < tagged_share:
+                tags = rng.choice(profile.node_tag_sets)
+                f.write('\t<node {0}>\n{1}\t</node>\n'.format(attributes, _tag_lines(tags)))
+            else:
+                f.write('\t<node {0} />\n'.format(attributes))
+            node_id += 1
+        counts['node'] = node_id - first_node_id
+
+        way_id = first_way_id
+        while f.tell() < size:
+            user, uid = rng.choice(profile.users)
+            length = rng.choice(profile.way_lengths)
+            start = rng.randint(first_node_id, max(first_node_id, node_id - length))
+            refs = [min(node_id - 1, start + i) for i in range(length)]
+            if rng.random() < 0.3:
+                refs[-1] = refs[0]  # closed way, like a building outline
+            f.write('\t<way changeset="{0}" id="{1}" timestamp="{2}" uid="{3}" user={4} '
+                    'version="{5}">\n'.format(rng.randint(1000000, 50000000), way_id, timestamp,
+                                              uid, quoteattr(user), rng.randint(1, 20)))
+            f.write(''.join('\t\t<nd ref="{0}" />\n'.format(ref) for ref in refs))
+            f.write(_tag_lines(rng.choice(profile.way_tag_sets)))
+            f.write('\t</way>\n')
+            way_id += 1
+        counts['way'] = way_id - first_way_id
+        f.write('</osm>\n')
+    return counts
+
+
+# ================================================== #
+#               Stages                               #
+# ================================================== #
+class Timer(object):
+    """Accumulate the time spent inside `with timer:` blocks"""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self._start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.time() - self._start
+
+
+def stage_parse(dc, osm_path, work_dir, parser):
+    timer = Timer()
+    count = 0
+    with timer:
+        for _ in osm_parser.iter_elements(osm_path, tags=('node', 'way'), parser=parser):
+            count += 1
+    return count, timer.seconds
+
+
+def stage_shape(dc, osm_path, work_dir, parser):
+    timer = Timer()
+    count = 0
+    for element in osm_parser.iter_elements(osm_path, tags=('node', 'way'), parser=parser):
+        with timer:
+            dc.shape_element(element, compact=True)
+        count += 1
+    return count, timer.seconds
+
+
+def stage_cleaners(dc, osm_path, work_dir, parser):
+    timer = Timer()
+    count = 0
+    rules = dc.CLEANING_RULES
+    for element in osm_parser.iter_elements(osm_path, tags=('node', 'way'), parser=parser):
+        for key, value in element.tags:
+            cleaner = rules.get(key)
+            if cleaner is not None:
+                with timer:
+                    cleaner(value)
+                count += 1
+    return count, timer.seconds
+
+
+def stage_validate(dc, osm_path, work_dir, parser, validator='compiled'):
+    timer = Timer()
+    count = 0
+    compiled = dc.make_validator(validator)
+    for element in osm_parser.iter_elements(osm_path, tags=('node', 'way'), parser=parser):
+        el = dc.shape_element(element, compact=True)
+        if el:
+            with timer:
+                dc.validate_compact(element.tag, el, compiled)
+            count += 1
+    return count, timer.seconds
+
+
+def stage_write(dc, osm_path, work_dir, parser):
+    timer = Timer()
+    count = 0
+    paths = [os.path.join(work_dir, os.path.basename(path)) for path in dc.OUTPUT_PATHS]
+    output = dc.CsvOutput(paths)
+    writers = output.writers
+    try:
+        for element in osm_parser.iter_elements(osm_path, tags=('node', 'way'), parser=parser):
+            el = dc.shape_element(element, compact=True)
+            if not el:
+                continue
+            with timer:
+                # A single-element write_elements, minus the shaping
+                if element.tag == 'node':
+                    writers[0].writetuples((el['node'],))
+                    writers[1].writetuples(el['node_tags'])
+                else:
+                    writers[2].writetuples((el['way'],))
+                    writers[3].writetuples(dc.way_node_rows(el['way'][0], el['way_nodes']),
+                                           encode=False)
+                    writers[4].writetuples(el['way_tags'])
+            count += 1
+        with timer:
+            output.close()
+    finally:
+        output.close()
+    return count, timer.seconds
+
+
+def stage_process_map(dc, osm_path, work_dir, parser, **options):
+    osm_path = os.path.abspath(osm_path)
+    count = sum(1 for _ in osm_parser.iter_elements(osm_path, tags=('node', 'way'), parser=parser))
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        start = time.time()
+        dc.process_map(osm_path, validate=True, parser=parser, **options)
+        seconds = time.time() - start
+    finally:
+        os.chdir(cwd)
+    return count, seconds
+
+
+def stage_runs(parsers, validators):
+    """Yield (name, function, kwargs) for every benchmark run"""
+    for parser in parsers:
+        yield 'parse[{0}]'.format(parser), stage_parse, dict(parser=parser)
+    yield 'shape', stage_shape, dict(parser=osm_parser.DEFAULT_PARSER)
+    yield 'cleaners', stage_cleaners, dict(parser=osm_parser.DEFAULT_PARSER)
+    for validator in validators:
+        yield 'validate[{0}]'.format(validator), stage_validate, dict(
+            parser=osm_parser.DEFAULT_PARSER, validator=validator)
+    yield 'write', stage_write, dict(parser=osm_parser.DEFAULT_PARSER)
+    yield 'process_map', stage_process_map, dict(parser=osm_parser.DEFAULT_PARSER)
+
+
+def _run_in_child(connection, function, osm_path, work_dir, kwargs):
+    try:
+        dc = load_cleaning()
+        count, seconds = function(dc, osm_path, work_dir, **kwargs)
+        # ru_maxrss is in KiB on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        connection.send({'items': count, 'seconds': seconds, 'peak_rss': peak_rss})
+    except Exception as e:
+        connection.send({'error': '{0}: {1}'.format(type(e).__name__, e)})
+    finally:
+        connection.close()
+
+
+def run_stage(function, osm_path, work_dir, kwargs, mb_rate=True):
+    """Run one stage in a forked process and return its measurements"""
+    stage_dir = tempfile.mkdtemp(dir=work_dir)
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_run_in_child,
+                                      args=(child, function, osm_path, stage_dir, kwargs))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {'error': 'benchmark process died (exit code {0})'.format(process.exitcode)}
+    process.join()
+    shutil.rmtree(stage_dir, ignore_errors=True)
+
+    if 'error' not in result:
+        size_mb = os.path.getsize(osm_path) / float(1 << 20)
+        seconds = max(result['seconds'], 1e-9)
+        result['items_per_sec'] = result['items'] / seconds
+        result['mb_per_sec'] = size_mb / seconds if mb_rate else None
+    return result
+
+
+def available_parsers():
+    return [parser for parser in sorted(osm_parser.PARSERS)
+            if parser != 'lxml' or osm_parser.lxml_etree is not None]
+
+
+def run_benchmarks(sizes, stages=STAGES, work_dir=None, keep=False, seed=0, report=sys.stdout,
+                   validators=('compiled',)):
+    """Generate a file of each size and benchmark the stages on it; return the results"""
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='osm_benchmark_')
+    profile = TagProfile.from_osm()
+    results = []
+    try:
+        for size in sizes:
+            osm_path = os.path.join(work_dir, 'synthetic_{0}.osm'.format(size))
+            start = time.time()
+            counts = generate_osm(osm_path, size, profile, seed)
+            report.write("\n{0}: {1:.1f} MB, {2} nodes, {3} ways (generated in {4:.1f}s)\n".format(
+                os.path.basename(osm_path), os.path.getsize(osm_path) / float(1 << 20),
+                counts['node'], counts['way'], time.time() - start))
+            report.write("{0:<22}{1:>12}{2:>14}{3:>10}{4:>14}\n".format(
+                "stage", "items", "items/sec", "MB/sec", "peak RSS MB"))
+
+            for name, function, kwargs in stage_runs(available_parsers(), validators):
+                if name.split('[')[0] not in stages:
+                    continue
+                result = run_stage(function, osm_path, work_dir, kwargs,
+                                   mb_rate=name.split('[')[0] not in NO_MB_RATE)
+                result.update(stage=name, size=size)
+                results.append(result)
+                if 'error' in result:
+                    report.write("{0:<22}{1}\n".format(name, result['error']))
+                else:
+                    mb_per_sec = result['mb_per_sec']
+                    report.write("{0:<22}{1:>12}{2:>14.0f}{3:>10}{4:>14.1f}\n".format(
+                        name, result['items'], result['items_per_sec'],
+                        '-' if mb_per_sec is None else '{0:.2f}'.format(mb_per_sec),
+                        result['peak_rss'] / float(1 << 20)))
+                report.flush()
+
+            if not keep:
+                os.remove(osm_path)
+    finally:
+        if own_dir and not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Benchmark the OSM cleaning pipeline")
+    arg_parser.add_argument("--sizes", default="10MB",
+                            help="comma separated sizes of the synthetic files, e.g. 10MB,1GB")
+    arg_parser.add_argument("--stages", default=",".join(STAGES),
+                            help="comma separated subset of " + ",".join(STAGES))
+    arg_parser.add_argument("--work-dir", help="where to write the synthetic files")
+    arg_parser.add_argument("--keep", action="store_true", help="keep the synthetic files")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--cerberus", action="store_true",
+                            help="also time validation with cerberus (slow: a few hundred elements/sec)")
+    arg_parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = arg_parser.parse_args()
+
+    results = run_benchmarks([parse_size(size) for size in args.sizes.split(",")],
+                             args.stages.split(","), args.work_dir, args.keep, args.seed,
+                             validators=('compiled', 'cerberus') if args.cerberus else ('compiled',))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
@@ -0,0 +1,123 @@
+"""
+Checkpoints of a long process_map run, so that it can resume where it stopped instead of starting
+over.
+
+Every CHECKPOINT_EVERY elements Checkpointer flushes the outputs to disk and records, in a small
+JSON file, the byte offset in the input of the next element, the last element written and the size
+of each output (bytes for csv files, the last rowid for SQLite tables). The audit counters, if any,
+are pickled next to it, alternating between two files so that the one the JSON file points to is
+always complete. To resume, the outputs are cut back to those sizes and parsing restarts at
+the recorded offset (osm_shards.remainder), so whatever was written after the checkpoint is written
+again exactly once.
+
+Checkpoints are taken between two elements: the element stream is consumed one element at a time,
+so when the next element is asked for, every row of the previous one has been handed to the
+writers. The offsets come from the expat parser (OsmElement.offset).
+"""
+import cPickle
+import json
+import os
+
+CHECKPOINT_EVERY = 100000
+FORMAT_VERSION = 1
+
+
+def _input_identity(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _write_atomic(path, data):
+    """Replace path with data, so that a crash leaves either the old or the new content"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class Checkpointer(object):
+    """Take a checkpoint of a run every `every` elements.
+
+    sink is the CsvOutput or SQLiteSink written to (it needs sync()), writers the ThreadedWriters
+    in front of it if any (they are drained first), counters the audit counters of the run and
+    base_offset the offset in input_path of the stream being parsed (see osm_shards.ShardReader)."""
+
+    def __init__(self, path, input_path, output, sink, base_offset=0, every=CHECKPOINT_EVERY,
+                 counters=None, writers=(), elements=0, saved=0):
+        self.path = path
+        self.input = _input_identity(input_path)
+        self.output = output
+        self.sink = sink
+        self.base_offset = base_offset
+        self.every = every
+        self.counters = counters
+        self.writers = writers
+        self.elements = elements
+        # Checkpoints taken so far, including those of the run being resumed
+        self.saved = saved
+
+    def track(self, elements):
+        """Yield elements, saving a checkpoint before one whenever one is due"""
+        last = None
+        until_checkpoint = self.every
+        for element in elements:
+            if until_checkpoint <= 0 and element.offset is not None:
+                self.save(self.base_offset + element.offset, last)
+                until_checkpoint = self.every
+            yield element
+            # Only reached once the consumer asks for the next element, i.e. is done with this one
+            last = element
+            until_checkpoint -= 1
+            self.elements += 1
+
+    def save(self, offset, last=None):
+        """Flush the outputs and record that the input continues at offset"""
+        for writer in self.writers:
+            writer.drain()
+        state = {
+            'format_version': FORMAT_VERSION,
+            'input': self.input,
+            'output': self.output,
+            'offset': offset,
+            'last_element': [last.tag, last.attrib['id']] if last is not None else None,
+            'elements': self.elements,
+            'checkpoints': self.saved + 1,
+            'output_sizes': self.sink.sync(),
+            'audit_file': None,
+        }
+        if self.counters is not None:
+            audit_path = '{0}.audit{1}'.format(self.path, self.saved % 2)
+            _write_atomic(audit_path, cPickle.dumps(self.counters, 2))
+            state['audit_file'] = os.path.basename(audit_path)
+        _write_atomic(self.path, json.dumps(state, indent=2, sort_keys=True))
+        self.saved += 1
+
+    def remove(self):
+        """Delete the checkpoint files, e.g. once the run is complete"""
+        for path in (self.path, self.path + '.audit0', self.path + '.audit1'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def load_checkpoint(path, input_path, output):
+    """Return the state saved at path and the audit counters saved with it (or None).
+
+    Raises ValueError if the checkpoint belongs to another input file or output format."""
+    with open(path) as f:
+        state = json.load(f)
+    if state.get('format_version') != FORMAT_VERSION:
+        raise ValueError("Unsupported checkpoint format version {0}".format(
+            state.get('format_version')))
+    if state['input'] != json.loads(json.dumps(_input_identity(input_path))):
+        raise ValueError("The checkpoint at '{0}' was taken for another version of '{1}'".format(
+            path, input_path))
+    if state['output'] != output:
+        raise ValueError("The checkpoint at '{0}' was taken for output='{1}'".format(
+            path, state['output']))
+    counters = None
+    if state['audit_file']:
+        with open(os.path.join(os.path.dirname(path), state['audit_file']), 'rb') as f:
+            counters = cPickle.load(f)
+    return state, counters
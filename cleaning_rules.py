@@ -0,0 +1,137 @@
+"""
+Registry of the tag cleaning functions used by shape_element.
+
+Each tag key (e.g. "addr:street") maps to one cleaner. The same street names, postcodes and phone
+numbers come up over and over in a map, so each cleaner is wrapped in a bounded LRU cache that keeps
+hit/miss counts and, while a clock is set (set_clock), the time spent in the cleaner itself. A
+cleaner returns the cleaned value, or None when the whole element should be dropped.
+"""
+from collections import namedtuple
+
+CACHE_SIZE = 4096
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+_MISSING = object()
+# Positions inside a link of the LRU list
+_PREV, _NEXT, _KEY, _RESULT = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """Memoize a one-argument function, keeping the maxsize most recently used results.
+
+    Same design as functools.lru_cache in Python 3: a dict for the lookups and a circular doubly
+    linked list of [prev, next, key, result] links for the recency order."""
+
+    def __init__(self, function, maxsize=CACHE_SIZE):
+        self.function = function
+        # What a cache miss calls: function itself, or a timed wrapper of it (see set_clock)
+        self._call = function
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+        self._links = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __call__(self, value):
+        link = self._links.get(value, _MISSING)
+        if link is not _MISSING:
+            # Move the link to the front (most recently used end) of the list
+            link_prev, link_next = link[_PREV], link[_NEXT]
+            link_prev[_NEXT] = link_next
+            link_next[_PREV] = link_prev
+            root = self._root
+            last = root[_PREV]
+            last[_NEXT] = root[_PREV] = link
+            link[_PREV] = last
+            link[_NEXT] = root
+            self.hits += 1
+            return link[_RESULT]
+
+        result = self._call(value)
+        self.misses += 1
+        if self.maxsize <= 0:
+            return result
+        root = self._root
+        if len(self._links) >= self.maxsize:
+            # Reuse the root as the new link and make the oldest link the new root
+            old_root = root
+            old_root[_KEY] = value
+            old_root[_RESULT] = result
+            self._root = root = old_root[_NEXT]
+            del self._links[root[_KEY]]
+            root[_KEY] = root[_RESULT] = None
+            self._links[value] = old_root
+        else:
+            last = root[_PREV]
+            link = [last, root, value, result]
+            last[_NEXT] = root[_PREV] = link
+            self._links[value] = link
+        return result
+
+    def set_clock(self, clock):
+        """Add the time of each call of function, measured with clock (e.g. time.time), to
+        seconds from now on; with clock=None the calls are no longer timed"""
+        if clock is None:
+            self._call = self.function
+            return
+        function = self.function
+
+        def timed(value):
+            start = clock()
+            result = function(value)
+            self.seconds += clock() - start
+            return result
+        self._call = timed
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._links))
+
+    def hit_rate(self):
+        calls = self.hits + self.misses
+        return float(self.hits) / calls if calls else 0.0
+
+    def clear(self):
+        self._links.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+        self.hits = self.misses = 0
+        self.seconds = 0.0
+
+
+class CleaningRules(object):
+    """Map tag keys to memoized cleaning functions"""
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self.rules = {}
+
+    def register(self, key, cleaner):
+        """Clean the values of tags with this key with cleaner (None from it drops the element)"""
+        self.rules[key] = LRUCache(cleaner, self.cache_size)
+
+    def get(self, key):
+        """Return the memoized cleaner for key, or None if the key's values are kept as they are"""
+        return self.rules.get(key)
+
+    def __contains__(self, key):
+        return key in self.rules
+
+    def keys(self):
+        return self.rules.keys()
+
+    def set_clock(self, clock):
+        """Time the cleaners with clock, or stop timing them with None (see LRUCache.set_clock)"""
+        for cache in self.rules.itervalues():
+            cache.set_clock(clock)
+
+    def stats(self):
+        """Return {key: {"hits", "misses", "hit_rate", "size", "seconds"}} for every rule's cache"""
+        stats = {}
+        for key, cache in self.rules.iteritems():
+            info = cache.cache_info()
+            stats[key] = {"hits": info.hits, "misses": info.misses, "hit_rate": cache.hit_rate(),
+                          "size": info.currsize, "seconds": cache.seconds}
+        return stats
@@ -0,0 +1,414 @@
+"""
+Columnar, memory-mappable output: one typed binary file per field instead of csv text.
+
+ColumnarSink has the same writers/add_table/load_csv/close interface as SQLiteSink, so process_map
+can write to it directly (output="columnar"). Each table gets a directory with one column per field:
+
+- "int64" (ids, uid, changeset, version, positions): native 64-bit integers
+- "float64" (coordinates): native doubles, NaN for empty values
+- "dictionary" (user, tag key and type, member type and role): int32 codes into a string column of the distinct values
+- "string" (everything else): int64 offsets (one more than there are rows) into a blob of the
+  utf-8 encoded values
+
+manifest.json at the top lists the tables, their row counts and the files and numpy dtypes of
+their columns. load() opens the result: with numpy every numeric column is a numpy.memmap, without
+it a read-only sequence over an mmap of the file.
+"""
+from array import array
+import csv
+import itertools
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+from int_arrays import INT64
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MANIFEST_FILE = 'manifest.json'
+FORMAT_VERSION = 1
+FLUSH_ROWS = 1 << 16
+BYTE_ORDER = '<' if sys.byteorder == 'little' else '>'
+
+COLUMN_KINDS = {
+    'id': 'int64',
+    'lat': 'float64',
+    'lon': 'float64',
+    'user': 'dictionary',
+    'uid': 'int64',
+    'version': 'int64',
+    'changeset': 'int64',
+    'timestamp': 'string',
+    'key': 'dictionary',
+    'value': 'string',
+    'type': 'dictionary',
+    'node_id': 'int64',
+    'position': 'int64',
+    'min_lat': 'float64',
+    'min_lon': 'float64',
+    'max_lat': 'float64',
+    'max_lon': 'float64',
+    'missing_nodes': 'int64',
+    'wkt': 'string',
+    'member_type': 'dictionary',
+    'member_id': 'int64',
+    'role': 'dictionary',
+}
+
+# kind -> (array typecode, numpy dtype, struct format)
+NUMERIC_TYPES = {
+    'int64': (INT64, BYTE_ORDER + 'i8', '=q'),
+    'float64': ('d', BYTE_ORDER + 'f8', '=d'),
+    'int32': ('i', BYTE_ORDER + 'i4', '=i'),
+}
+
+
+def _to_float(value):
+    return float(value) if value != '' else float('nan')
+
+
+def _to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+
+# ================================================== #
+#               Writing                              #
+# ================================================== #
+class NumericColumn(object):
+    """Values appended to a buffer and written to path every FLUSH_ROWS rows"""
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.typecode, self.dtype, _ = NUMERIC_TYPES[kind]
+        self.convert = _to_float if kind == 'float64' else int
+        self.file = open(path, 'wb')
+        self.values = array(self.typecode)
+
+    def append(self, value):
+        self.values.append(self.convert(value))
+
+    def flush(self):
+        self.values.tofile(self.file)
+        self.values = array(self.typecode)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def describe(self, root):
+        return {'kind': self.kind, 'dtype': self.dtype, 'file': os.path.relpath(self.path, root)}
+
+
+class StringColumn(object):
+    """utf-8 values concatenated in a blob file, with their int64 offsets in another file"""
+
+    def __init__(self, path, kind='string'):
+        self.path = path
+        self.kind = kind
+        self.offsets = NumericColumn(path + '.offsets', 'int64')
+        self.blob = open(path + '.blob', 'wb')
+        self.size = 0
+        self.offsets.append(0)
+
+    def append(self, value):
+        data = _to_bytes(value)
+        self.blob.write(data)
+        self.size += len(data)
+        self.offsets.append(self.size)
+
+    def flush(self):
+        self.offsets.flush()
+
+    def close(self):
+        self.offsets.close()
+        self.blob.close()
+
+    def describe(self, root):
+        return {'kind': self.kind, 'offsets': os.path.relpath(self.offsets.path, root),
+                'offsets_dtype': self.offsets.dtype, 'blob': os.path.relpath(self.path + '.blob', root)}
+
+
+class DictionaryColumn(object):
+    """int32 codes of the values, with the distinct values in a StringColumn in code order"""
+
+    def __init__(self, path, kind='dictionary'):
+        self.path = path
+        self.kind = kind
+        self.codes = NumericColumn(path + '.codes', 'int32')
+        self.values = StringColumn(path + '.values')
+        self.lookup = {}
+
+    def append(self, value):
+        value = _to_bytes(value)
+        code = self.lookup.get(value)
+        if code is None:
+            code = self.lookup[value] = len(self.lookup)
+            self.values.append(value)
+        self.codes.values.append(code)
+
+    def flush(self):
+        self.codes.flush()
+        self.values.flush()
+
+    def close(self):
+        self.codes.close()
+        self.values.close()
+
+    def describe(self, root):
+        return {'kind': self.kind, 'codes': os.path.relpath(self.codes.path, root),
+                'codes_dtype': self.codes.dtype, 'values': self.values.describe(root)}
+
+
+COLUMN_CLASSES = {
+    'int64': NumericColumn,
+    'float64': NumericColumn,
+    'string': StringColumn,
+    'dictionary': DictionaryColumn,
+}
+
+
+class ColumnarTableWriter(object):
+    """Append rows to the columns of one table"""
+
+    def __init__(self, directory, table, fields):
+        self.table = table
+        self.fields = fields
+        self.directory = os.path.join(directory, table)
+        os.makedirs(self.directory)
+        self.columns = []
+        for field in fields:
+            kind = COLUMN_KINDS.get(field, 'string')
+            self.columns.append(COLUMN_CLASSES[kind](os.path.join(self.directory, field), kind))
+        self.rows = 0
+        self._until_flush = FLUSH_ROWS
+
+    def writerow(self, row):
+        self.writetuples(((row[field] for field in self.fields),))
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def writetuples(self, rows, encode=True):
+        """Write rows that are already tuples in the order of fields.
+
+        encode is accepted for compatibility with UnicodeDictWriter; strings are always stored
+        utf-8 encoded."""
+        appends = [column.append for column in self.columns]
+        for row in rows:
+            for append, value in itertools.izip(appends, row):
+                append(value)
+            self.rows += 1
+            self._until_flush -= 1
+            if self._until_flush <= 0:
+                self.flush()
+
+    def flush(self):
+        self._until_flush = FLUSH_ROWS
+        for column in self.columns:
+            column.flush()
+
+    def close(self):
+        for column in self.columns:
+            column.close()
+
+    def describe(self, root):
+        return {'rows': self.rows, 'fields': list(self.fields),
+                'columns': dict((field, column.describe(root))
+                                for field, column in zip(self.fields, self.columns))}
+
+
+class ColumnarSink(object):
+    """Directory of columnar tables with a manifest, written in one pass"""
+
+    def __init__(self, directory, tables, fields, overwrite=True):
+        if INT64 is None:
+            raise RuntimeError("The columnar output needs a 64-bit integer array type")
+        if os.path.exists(directory):
+            if not overwrite:
+                raise IOError("'{0}' already exists".format(directory))
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        self.directory = directory
+        self.tables = []
+        self.writers = []
+        for table, table_fields in zip(tables, fields):
+            self.add_table(table, None, table_fields)
+
+    def add_table(self, table, path, fields):
+        """Create one more table and return its writer (path is only used by the csv output)"""
+        writer = ColumnarTableWriter(self.directory, table, fields)
+        self.tables.append(table)
+        self.writers.append(writer)
+        return writer
+
+    def load_csv(self, index, path):
+        """Append the rows of a headerless csv file (e.g. from a shard) to table number index"""
+        with open(path, 'rb') as csv_file:
+            self.writers[index].writetuples(csv.reader(csv_file))
+
+    def close(self):
+        """Write the last rows and the manifest"""
+        for writer in self.writers:
+            writer.close()
+        manifest = {'format_version': FORMAT_VERSION,
+                    'tables': dict((table, writer.describe(self.directory))
+                                   for table, writer in zip(self.tables, self.writers))}
+        with open(os.path.join(self.directory, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def abort(self):
+        """Close the files without writing a manifest, e.g. after an error"""
+        for writer in self.writers:
+            writer.close()
+
+
+# ================================================== #
+#               Loading                              #
+# ================================================== #
+class MappedArray(object):
+    """Read-only sequence of fixed-size numbers over an mmap, for when numpy is not installed"""
+
+    def __init__(self, path, dtype):
+        self.struct = struct.Struct(dtype[0] + _STRUCT_CODES[dtype[1:]])
+        size = os.path.getsize(path)
+        self.length = size // self.struct.size
+        self.mapped = None
+        if size:
+            with open(path, 'rb') as f:
+                self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self.struct.unpack_from(self.mapped, i * self.struct.size)[0]
+
+    def __iter__(self):
+        unpack_from, size = self.struct.unpack_from, self.struct.size
+        for i in xrange(self.length):
+            yield unpack_from(self.mapped, i * size)[0]
+
+
+_STRUCT_CODES = {'i8': 'q', 'f8': 'd', 'i4': 'i'}
+
+
+def map_array(path, dtype):
+    """Memory map a numeric column file: a numpy.memmap if numpy is installed, else a MappedArray"""
+    if numpy is None:
+        return MappedArray(path, dtype)
+    if os.path.getsize(path) == 0:
+        # numpy.memmap cannot map empty files
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r')
+
+
+class StringValues(object):
+    """Read-only sequence of the str values of a string column"""
+
+    def __init__(self, root, description):
+        self.offsets = map_array(os.path.join(root, description['offsets']),
+                                 description['offsets_dtype'])
+        blob_path = os.path.join(root, description['blob'])
+        self.blob = None
+        if os.path.getsize(blob_path):
+            with open(blob_path, 'rb') as f:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.blob[start:end] if end > start else b''
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class DictionaryValues(object):
+    """Read-only sequence of the values of a dictionary column; codes and values give access to
+    the encoding itself (e.g. for numpy.bincount(column.codes))"""
+
+    def __init__(self, root, description):
+        self.codes = map_array(os.path.join(root, description['codes']), description['codes_dtype'])
+        self.values = list(StringValues(root, description['values']))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def __iter__(self):
+        values = self.values
+        for code in self.codes:
+            yield values[code]
+
+
+class ColumnarTable(object):
+    """One table of a columnar output; its columns are opened when they are first asked for"""
+
+    def __init__(self, root, name, description):
+        self.root = root
+        self.name = name
+        self.rows = description['rows']
+        self.fields = description['fields']
+        self.descriptions = description['columns']
+        self._columns = {}
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, field):
+        column = self._columns.get(field)
+        if column is None:
+            column = self._columns[field] = self._open(self.descriptions[field])
+        return column
+
+    def _open(self, description):
+        kind = description['kind']
+        if kind == 'string':
+            return StringValues(self.root, description)
+        elif kind == 'dictionary':
+            return DictionaryValues(self.root, description)
+        return map_array(os.path.join(self.root, description['file']), description['dtype'])
+
+
+class ColumnarDataset(object):
+    """The tables of a columnar output directory, by name"""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format_version'] != FORMAT_VERSION:
+            raise ValueError("Unsupported columnar format version {0}".format(
+                self.manifest['format_version']))
+        self.tables = dict((name, ColumnarTable(directory, name, description))
+                           for name, description in self.manifest['tables'].items())
+
+    def __getitem__(self, table):
+        return self.tables[table]
+
+
+def load(directory):
+    """Open the columnar output in directory, e.g. load("columnar_sanjose")["nodes"]["lat"]"""
+    return ColumnarDataset(directory)
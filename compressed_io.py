@@ -0,0 +1,127 @@
+"""
+Reading compressed OSM extracts and writing compressed csv files.
+
+Input: .osm.bz2 and .osm.gz files are recognized by their extension and decompressed on the fly,
+in a background thread (ThreadedReader) so that decompression overlaps with parsing; bz2 and zlib
+release the GIL while they work. Files made of several concatenated streams (pbzip2, or
+concatenated gzip members) are read to the end, unlike with bz2.BZ2File in Python 2.
+
+Output: CompressedWriter is a buffered file-like object that gzip or zstd compresses what is
+written to it. zstd needs the zstandard package.
+"""
+import bz2
+import zlib
+
+from threaded_io import ThreadedReader, READ_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INPUT_COMPRESSIONS = {'.bz2': 'bz2', '.gz': 'gzip'}
+OUTPUT_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+WRITE_BUFFER = 1 << 20
+
+
+def compression_of(path):
+    """Return "bz2" or "gzip" for a compressed input path, None for a plain one"""
+    for suffix, compression in INPUT_COMPRESSIONS.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def _decompressor(compression):
+    if compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    raise ValueError("Unknown compression '{0}', expected one of {1}".format(
+        compression, sorted(INPUT_COMPRESSIONS.values())))
+
+
+class DecompressingReader(object):
+    """File-like object returning the decompressed content of f, across concatenated streams"""
+
+    def __init__(self, f, compression, read_size=READ_SIZE):
+        self.f = f
+        self.compression = compression
+        self.read_size = read_size
+        self.decompressor = _decompressor(compression)
+
+    def read(self, size=-1):
+        """Return the next decompressed chunk ('' at the end); size is ignored"""
+        while True:
+            data = self.f.read(self.read_size)
+            if not data:
+                return b''
+            chunks = []
+            while data:
+                try:
+                    chunks.append(self.decompressor.decompress(data))
+                except EOFError:
+                    # The last stream (bz2) ended exactly at the end of the previous read
+                    self.decompressor = _decompressor(self.compression)
+                    continue
+                # Whatever follows the end of a stream is the start of the next one
+                data = self.decompressor.unused_data
+                if data:
+                    self.decompressor = _decompressor(self.compression)
+            chunk = b''.join(chunks)
+            if chunk:
+                return chunk
+
+    def close(self):
+        self.f.close()
+
+
+def open_compressed(source, compression=None, read_size=READ_SIZE):
+    """Open a compressed path (or an already opened compressed file) for reading.
+
+    The decompression runs in a background thread; the result is a ThreadedReader."""
+    if not hasattr(source, 'read'):
+        compression = compression or compression_of(source)
+        source = open(source, 'rb')
+    return ThreadedReader(DecompressingReader(source, compression, read_size))
+
+
+class CompressedWriter(object):
+    """Write-only file-like object compressing its content into path with gzip or zstd"""
+
+    def __init__(self, path, compression, buffer_size=WRITE_BUFFER):
+        if compression == 'gzip':
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ImportError("compression='zstd' needs the zstandard package")
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            raise ValueError("Unknown compression '{0}', expected one of {1}".format(
+                compression, sorted(OUTPUT_SUFFIXES)))
+        self.f = open(path, 'wb')
+        self.buffer_size = buffer_size
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data):
+        # csv writes one row at a time; compress in large pieces instead
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._chunks:
+            self.f.write(self.compressor.compress(b''.join(self._chunks)))
+            self._chunks = []
+            self._size = 0
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.flush()
+        self.f.write(self.compressor.flush())
+        self.f.close()
@@ -0,0 +1,27 @@
+"""Compact typed arrays for OSM ids.
+
+Node, way and relation ids no longer fit in 32 bits. Python 2's array module has no 'q' type, so
+the 64-bit integer type code is looked up once here: 'q' where it exists, else 'l' where C longs
+are 64 bits. On platforms with neither, plain lists are used instead.
+"""
+from array import array
+
+
+def _int64_typecode():
+    for typecode in ('q', 'l'):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+
+INT64 = _int64_typecode()
+
+
+def int64_array(values=()):
+    """Return values as an array of 64-bit ints (or a list where there is no such array type)"""
+    if INT64 is None:
+        return list(values)
+    return array(INT64, values)
@@ -0,0 +1,321 @@
+"""
+On-disk, memory-mapped index of node locations, used to write way geometries in the same pass.
+
+While the nodes stream by, their ids and coordinates are appended to spill files. When the first
+way comes along the index is built from them:
+
+- The id space is cut into blocks of BLOCK_SPAN ids. Blocks where at least DENSE_FILL of the ids
+  exist are stored densely: one (lat, lon) slot per id, looked up by offset.
+- The nodes of all other blocks go into sorted sparse arrays (ids, and coordinates next to them),
+  looked up with a binary search.
+
+Coordinates are stored as int32 fixed point (degrees * 10**7, the precision of OSM). Files use the
+native byte order, the index is only meant for the run that builds it. Memory use does not depend
+on the number of nodes: the files are read through mmap, and unsorted input is sorted in bounded
+runs on disk before the index is built.
+"""
+from array import array
+from bisect import bisect_left
+import heapq
+import json
+import mmap
+import os
+import struct
+
+from int_arrays import INT64, int64_array
+
+BLOCK_SPAN = 1 << 16
+DENSE_FILL = 0.5
+SPILL_RECORDS = 1 << 18
+SORT_RUN_RECORDS = 1 << 22
+
+SCALE = 10 ** 7
+MISSING = -(1 << 31)
+COORD = struct.Struct('=ii')
+ID = struct.Struct('=q')
+
+IDS_FILE = 'ids.bin'
+COORDS_FILE = 'coords.bin'
+DENSE_FILE = 'dense.bin'
+DENSE_BLOCKS_FILE = 'dense_blocks.bin'
+SPARSE_IDS_FILE = 'sparse_ids.bin'
+SPARSE_COORDS_FILE = 'sparse_coords.bin'
+META_FILE = 'index.json'
+
+
+def to_fixed(degrees):
+    return int(round(float(degrees) * SCALE))
+
+
+def from_fixed(value):
+    return value / float(SCALE)
+
+
+def _read_records(ids_path, coords_path, chunk=SPILL_RECORDS):
+    """Yield (id, lat, lon) from a pair of id/coordinate spill files"""
+    with open(ids_path, 'rb') as ids_file, open(coords_path, 'rb') as coords_file:
+        while True:
+            ids = int64_array()
+            coords = array('i')
+            try:
+                ids.fromfile(ids_file, chunk)
+            except EOFError:
+                pass
+            if not ids:
+                return
+            coords.fromfile(coords_file, 2 * len(ids))
+            for i, node_id in enumerate(ids):
+                yield node_id, coords[2 * i], coords[2 * i + 1]
+
+
+def _write_records(records, ids_file, coords_file):
+    ids = int64_array([record[0] for record in records])
+    coords = array('i')
+    for record in records:
+        coords.append(record[1])
+        coords.append(record[2])
+    ids.tofile(ids_file)
+    coords.tofile(coords_file)
+
+
+class NodeIndexBuilder(object):
+    """Collect node locations and build a NodeIndex in directory"""
+
+    def __init__(self, directory, block_span=BLOCK_SPAN, dense_fill=DENSE_FILL):
+        if INT64 is None:
+            raise RuntimeError("The node index needs a 64-bit integer array type")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.block_span = block_span
+        self.dense_fill = dense_fill
+        self.ids = int64_array()
+        self.coords = array('i')
+        self.count = 0
+        self.last_id = None
+        self.is_sorted = True
+        self._ids_file = open(self._path(IDS_FILE), 'wb')
+        self._coords_file = open(self._path(COORDS_FILE), 'wb')
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def add(self, node_id, lat, lon):
+        """Add one node; lat and lon are in degrees (strings are fine)"""
+        node_id = int(node_id)
+        if self.last_id is not None and node_id <= self.last_id:
+            self.is_sorted = False
+        self.last_id = node_id
+        self.ids.append(node_id)
+        self.coords.append(to_fixed(lat))
+        self.coords.append(to_fixed(lon))
+        self.count += 1
+        if len(self.ids) >= SPILL_RECORDS:
+            self._spill()
+
+    def _spill(self):
+        self.ids.tofile(self._ids_file)
+        self.coords.tofile(self._coords_file)
+        self.ids = int64_array()
+        self.coords = array('i')
+
+    def _sorted_records(self):
+        """Yield the spilled records in id order, sorting them in runs on disk if needed"""
+        ids_path, coords_path = self._path(IDS_FILE), self._path(COORDS_FILE)
+        if self.is_sorted:
+            return _read_records(ids_path, coords_path)
+
+        runs = []
+        records = _read_records(ids_path, coords_path)
+        while True:
+            run = []
+            for record in records:
+                run.append(record)
+                if len(run) >= SORT_RUN_RECORDS:
+                    break
+            if not run:
+                break
+            run.sort()
+            run_paths = (self._path('run{0}.ids'.format(len(runs))),
+                         self._path('run{0}.coords'.format(len(runs))))
+            with open(run_paths[0], 'wb') as ids_file, open(run_paths[1], 'wb') as coords_file:
+                _write_records(run, ids_file, coords_file)
+            runs.append(run_paths)
+        return heapq.merge(*[_read_records(*paths) for paths in runs])
+
+    def build(self):
+        """Write the dense and sparse index files and return the opened NodeIndex"""
+        self._spill()
+        self._ids_file.close()
+        self._coords_file.close()
+
+        span = self.block_span
+        dense_blocks = int64_array()
+        with open(self._path(DENSE_FILE), 'wb') as dense_file, \
+             open(self._path(SPARSE_IDS_FILE), 'wb') as sparse_ids_file, \
+             open(self._path(SPARSE_COORDS_FILE), 'wb') as sparse_coords_file:
+
+            def write_block(block, records):
+                if len(records) >= self.dense_fill * span:
+                    slots = array('i', [MISSING]) * (2 * span)
+                    base = block * span
+                    for node_id, lat, lon in records:
+                        slot = 2 * (node_id - base)
+                        slots[slot] = lat
+                        slots[slot + 1] = lon
+                    slots.tofile(dense_file)
+                    dense_blocks.append(block)
+                else:
+                    _write_records(records, sparse_ids_file, sparse_coords_file)
+
+            block = None
+            records = []
+            last_id = None
+            for record in self._sorted_records():
+                if record[0] == last_id:
+                    # Duplicate node id: keep a single location for it
+                    records[-1] = record
+                    continue
+                last_id = record[0]
+                record_block = record[0] // span
+                if record_block != block:
+                    if records:
+                        write_block(block, records)
+                    block = record_block
+                    records = []
+                records.append(record)
+            if records:
+                write_block(block, records)
+
+        with open(self._path(DENSE_BLOCKS_FILE), 'wb') as blocks_file:
+            dense_blocks.tofile(blocks_file)
+        with open(self._path(META_FILE), 'w') as meta_file:
+            json.dump({'block_span': span, 'nodes': self.count,
+                       'dense_blocks': len(dense_blocks)}, meta_file)
+
+        for name in os.listdir(self.directory):
+            if name.startswith('run') or name in (IDS_FILE, COORDS_FILE):
+                os.remove(self._path(name))
+        return NodeIndex(self.directory)
+
+
+class _MappedInt64s(object):
+    """Read-only int64 sequence over a memory map, for bisect"""
+
+    def __init__(self, mapped):
+        self.mapped = mapped
+        self.length = len(mapped) // ID.size if mapped is not None else 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return ID.unpack_from(self.mapped, i * ID.size)[0]
+
+
+def _map_file(path):
+    """Memory map a file read-only, or return None if it is empty"""
+    if os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class NodeIndex(object):
+    """Memory mapped node id -> (lat, lon) lookup written by NodeIndexBuilder"""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, META_FILE)) as meta_file:
+            meta = json.load(meta_file)
+        self.block_span = meta['block_span']
+        blocks = int64_array()
+        with open(os.path.join(directory, DENSE_BLOCKS_FILE), 'rb') as blocks_file:
+            try:
+                blocks.fromfile(blocks_file, meta['dense_blocks'])
+            except EOFError:
+                pass
+        block_size = self.block_span * COORD.size
+        self.dense_offsets = dict((block, i * block_size) for i, block in enumerate(blocks))
+        self.dense = _map_file(os.path.join(directory, DENSE_FILE))
+        self.sparse_ids = _MappedInt64s(_map_file(os.path.join(directory, SPARSE_IDS_FILE)))
+        self.sparse_coords = _map_file(os.path.join(directory, SPARSE_COORDS_FILE))
+
+    def get_fixed(self, node_id):
+        """Return (lat, lon) as int32 fixed point, or None for an unknown node"""
+        block, slot = divmod(node_id, self.block_span)
+        offset = self.dense_offsets.get(block)
+        if offset is not None:
+            location = COORD.unpack_from(self.dense, offset + slot * COORD.size)
+            return None if location[0] == MISSING else location
+
+        ids = self.sparse_ids
+        i = bisect_left(ids, node_id)
+        if i < len(ids) and ids[i] == node_id:
+            return COORD.unpack_from(self.sparse_coords, i * COORD.size)
+        return None
+
+    def get(self, node_id):
+        """Return (lat, lon) in degrees, or None for an unknown node"""
+        location = self.get_fixed(int(node_id))
+        if location is None:
+            return None
+        return from_fixed(location[0]), from_fixed(location[1])
+
+    def close(self):
+        for mapped in (self.dense, self.sparse_ids.mapped, self.sparse_coords):
+            if mapped is not None:
+                mapped.close()
+
+
+def format_degrees(value):
+    return ('%.7f' % from_fixed(value)).rstrip('0').rstrip('.')
+
+
+class WayGeometryWriter(object):
+    """Index the nodes while they stream by, then write a bbox and WKT line per way.
+
+    The index is built when the first way is written, so all nodes have to come before the ways
+    (the usual order of OSM files). Each row holds the way id, its bounding box, the number of
+    refs that are not in the index and a WKT LINESTRING of the nodes that are."""
+
+    def __init__(self, writer, directory, **builder_options):
+        self.writer = writer
+        self.builder = NodeIndexBuilder(directory, **builder_options)
+        self.index = None
+
+    def add_node(self, node_id, lat, lon):
+        if self.index is None:
+            self.builder.add(node_id, lat, lon)
+
+    def write_way(self, way_id, refs):
+        if self.index is None:
+            self.index = self.builder.build()
+        get_fixed = self.index.get_fixed
+
+        points = []
+        missing = 0
+        for ref in refs:
+            location = get_fixed(int(ref))
+            if location is None:
+                missing += 1
+            else:
+                points.append(location)
+
+        if points:
+            lats = [point[0] for point in points]
+            lons = [point[1] for point in points]
+            bbox = (format_degrees(min(lats)), format_degrees(min(lons)),
+                    format_degrees(max(lats)), format_degrees(max(lons)))
+        else:
+            bbox = ('', '', '', '')
+        if len(points) >= 2:
+            wkt = 'LINESTRING (' + ', '.join(
+                format_degrees(lon) + ' ' + format_degrees(lat) for lat, lon in points) + ')'
+        else:
+            wkt = ''
+        self.writer.writetuples(((way_id,) + bbox + (missing, wkt),), encode=False)
+
+    def close(self):
+        if self.index is None:
+            self.index = self.builder.build()
+        self.index.close()
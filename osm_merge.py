@@ -0,0 +1,217 @@
+"""
+Merge several overlapping OSM extracts into one stream without duplicates.
+
+Neighbouring extracts share the elements along their borders, often in different versions.
+ExtractMerger reads the extracts side by side with a k-way merge (heapq.merge) on (type, id),
+type in node, way, relation order, and yields each element once, in its highest version; equal
+versions are taken from the input listed first. The result is in the order of a single sorted
+OSM file, so it can go through the same pipeline (area filter, geometry) as one.
+
+The merge needs every input in (type, id) order, as extracts from Geofabrik or osmium are. By
+default each input is checked when the merger is created, with a quick scan of its start tags
+(is_sorted), so a caller can create it before opening any output. Sorted inputs are streamed
+straight into the merge. An input that is not sorted is read in runs of RUN_ELEMENTS elements,
+each sorted in memory and spilled to a temporary file with cPickle, and the runs are merged
+instead. When there are more than MERGE_FAN_IN inputs and runs, groups of them are merged into
+bigger runs first. Either way memory is bounded by the run size and the fan-in, not by the size
+or the number of the inputs.
+
+sorted_inputs=True skips the scan; the merge then stops with a ValueError as soon as an input
+turns out not to be sorted, after merged elements have already been handed on.
+sorted_inputs=False spills every input without scanning.
+"""
+from collections import defaultdict
+import cPickle
+import heapq
+from itertools import count
+import os
+import re
+import shutil
+import tempfile
+
+from compressed_io import compression_of, open_compressed
+from osm_parser import DEFAULT_PARSER, ELEMENT_TYPES, iter_elements
+
+RUN_ELEMENTS = 200000
+MERGE_FAN_IN = 64
+RUN_BUFFER = 1 << 16
+SCAN_SIZE = 1 << 20
+
+TYPE_ORDER = {'node': 0, 'way': 1, 'relation': 2}
+
+# A top-level start tag up to its id attribute; attribute values are skipped whole since they
+# may contain '>'
+TOP_LEVEL_ID = re.compile(r'<(node|way|relation)(?:\s+[\w:.-]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*?'
+                          r'\s+id\s*=\s*["\'](-?\d+)["\']')
+
+
+def element_key(element):
+    """Return the (type, id) merge key of an OsmElement"""
+    return TYPE_ORDER[element.tag], int(element.attrib['id'])
+
+
+def _version(element):
+    return int(element.attrib.get('version', 0))
+
+
+def is_sorted(path, scan_size=SCAN_SIZE):
+    """True if the top-level elements of the OSM file at path are in (type, id) order.
+
+    Only the start tags are looked at, with a regular expression, which is much faster than
+    parsing the file."""
+    if compression_of(path):
+        f = open_compressed(path)
+    else:
+        f = open(path, 'rb')
+    previous = None
+    carry = ''
+    try:
+        while True:
+            data = f.read(scan_size)
+            window = carry + data
+            # A tag cut off by the end of the window is looked at again with the next read
+            cut = window.rfind('<') if data else len(window)
+            for m in TOP_LEVEL_ID.finditer(window, 0, max(cut, 0)):
+                key = (TYPE_ORDER[m.group(1)], int(m.group(2)))
+                if previous is not None and key < previous:
+                    return False
+                previous = key
+            if not data:
+                return True
+            carry = window[cut:] if cut >= 0 else ''
+    finally:
+        f.close()
+
+
+class ExtractMerger(object):
+    """Merge the elements of several OSM extracts by (type, id), keeping the highest version.
+
+    opener, if given, is called with each path and returns the file-like object to parse (e.g. to
+    count the bytes read); it is closed once the input is read. With sorted_inputs=None each input
+    is checked with is_sorted here, True trusts that they are sorted and False sorts all of them.
+    The runs are spilled to a temporary directory inside work_dir."""
+
+    def __init__(self, paths, parser=DEFAULT_PARSER, tags=ELEMENT_TYPES,
+                 work_dir=None, sorted_inputs=None, run_elements=RUN_ELEMENTS,
+                 fan_in=MERGE_FAN_IN, opener=None):
+        if fan_in < 2:
+            raise ValueError("fan_in has to be at least 2")
+        self.paths = list(paths)
+        self.parser = parser
+        self.tags = tags
+        self.work_dir = work_dir
+        self.run_elements = run_elements
+        self.fan_in = fan_in
+        self.opener = opener
+        # Elements left out because another input has them in a higher (or the same) version
+        self.duplicates = defaultdict(int)
+        # The inputs that are sorted on disk first, and the runs written to disk
+        if sorted_inputs is None:
+            self.unsorted = [path for path in self.paths if not is_sorted(path)]
+        else:
+            self.unsorted = [] if sorted_inputs else list(self.paths)
+        self.runs = 0
+        self._run_dir = None
+        self._sequence = count()
+
+    def elements(self):
+        """Yield the merged OsmElements"""
+        try:
+            sources = []
+            for index, path in enumerate(self.paths):
+                if path in self.unsorted:
+                    sources.extend(self._spill_sorted(self._items(index, path)))
+                else:
+                    sources.append(self._checked(self._items(index, path), path))
+            while len(sources) > self.fan_in:
+                sources = [self._spill(self._merge(sources[start:start + self.fan_in]))
+                           for start in xrange(0, len(sources), self.fan_in)]
+            for item in self._merge(sources):
+                yield item[-1]
+        finally:
+            self.close()
+
+    def close(self):
+        """Remove the spilled runs"""
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+
+    def _items(self, index, path):
+        """Yield (key, -version, input index, sequence, element) for each element of one input;
+        sorting on these puts the element to keep first among those with the same key"""
+        source = self.opener(path) if self.opener is not None else path
+        sequence = self._sequence
+        try:
+            for element in iter_elements(source, tags=self.tags, parser=self.parser):
+                yield element_key(element), -_version(element), index, next(sequence), element
+        finally:
+            if source is not path:
+                source.close()
+
+    def _checked(self, items, path):
+        """Pass the items of an input on, making sure it really is sorted"""
+        previous_key = None
+        for item in items:
+            key = item[0]
+            if previous_key is not None and key < previous_key:
+                raise ValueError("'{0}' is not sorted by type and id, use "
+                                 "sorted_inputs=None or False".format(path))
+            previous_key = key
+            yield item
+
+    def _merge(self, sources):
+        """k-way merge sources of sorted items, dropping all but the first item of each key.
+
+        heapq.merge has no key argument in Python 2, hence the items are tuples starting with
+        their sort key."""
+        previous_key = None
+        duplicates = self.duplicates
+        for item in heapq.merge(*sources):
+            key = item[0]
+            if key == previous_key:
+                duplicates[item[-1].tag] += 1
+                continue
+            previous_key = key
+            yield item
+
+    def _spill_sorted(self, items):
+        """Sort items in runs of run_elements, spill each run and return readers of the runs"""
+        runs = []
+        run = []
+        for item in items:
+            run.append(item)
+            if len(run) >= self.run_elements:
+                run.sort()
+                runs.append(self._spill(run))
+                run = []
+        if run:
+            run.sort()
+            runs.append(self._spill(run))
+        return runs
+
+    def _spill(self, items):
+        """Write sorted items to a run file and return a generator reading them back"""
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(prefix='osm_merge_', dir=self.work_dir)
+        fd, path = tempfile.mkstemp(suffix='.run', dir=self._run_dir)
+        with os.fdopen(fd, 'wb', RUN_BUFFER) as f:
+            pickler = cPickle.Pickler(f, 2)
+            for item in items:
+                pickler.dump(item)
+                # The pickler would otherwise remember every item it wrote
+                pickler.clear_memo()
+        self.runs += 1
+        return _read_run(path)
+
+
+def _read_run(path):
+    with open(path, 'rb', RUN_BUFFER) as f:
+        unpickler = cPickle.Unpickler(f)
+        while True:
+            try:
+                item = unpickler.load()
+            except EOFError:
+                break
+            yield item
+    os.remove(path)
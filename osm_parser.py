@@ -0,0 +1,183 @@
+"""Iterative parsing of OSM XML files shared by the audit and cleaning scripts
+
+Besides get_element, which yields full ElementTree elements, iter_elements yields compact OsmElement
+tuples that only keep what shape_element and the audit need: the top level attributes, the (k, v)
+pairs of the <tag> children, the refs of the <nd> children and the (type, ref, role) of the
+<member> children. Several parser backends can produce them:
+
+- "expat": a SAX-style handler on top of pyexpat. No element objects are built at all, the input is
+  fed in fixed-size chunks so memory stays flat however big the file is. This is the default.
+  Values are returned as utf-8 encoded str, which the csv writers can write without re-encoding.
+- "lxml": lxml's iterparse restricted to the requested tags (needs lxml to be installed).
+- "etree": the original cElementTree iterparse path, converted to OsmElement tuples.
+
+iter_changes reads osmChange (.osc) files the same way, with the action of each element.
+
+Paths ending in .bz2 or .gz are decompressed on the fly (see compressed_io).
+"""
+from collections import namedtuple
+from functools import partial
+import xml.etree.cElementTree as ET
+from xml.parsers import expat
+
+from compressed_io import compression_of, open_compressed
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+READ_SIZE = 1 << 20
+DEFAULT_PARSER = 'expat'
+# The top level OSM elements, in the order of a sorted OSM file
+ELEMENT_TYPES = ('node', 'way', 'relation')
+# The blocks of an osmChange file
+ACTIONS = frozenset(['create', 'modify', 'delete'])
+
+# tag: "node", "way" or "relation", attrib: dict of the top level attributes,
+# tags: list of (k, v) tuples, refs: list of the nd refs (ways only),
+# members: list of (type, ref, role) tuples (relations only, else an empty tuple),
+# offset: byte offset of the element's start tag in the parsed stream (expat only, else None)
+OsmElement = namedtuple('OsmElement', ['tag', 'attrib', 'tags', 'refs', 'members', 'offset'])
+OsmElement.__new__.__defaults__ = ((), None)
+
+
+def get_element(osm_file, tags=ELEMENT_TYPES):
+    """Yield element if it is the right type of tag"""
+
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag in tags:
+            yield elem
+            root.clear()
+
+
+def from_etree(elem):
+    """Convert an ElementTree element to an OsmElement.
+
+    The attributes are copied: lxml's attrib is a live view of an element that gets cleared once
+    it is parsed, and it can not be pickled."""
+    tags = []
+    refs = []
+    members = [] if elem.tag == 'relation' else ()
+    for child in elem:
+        if child.tag == 'tag':
+            tags.append((child.attrib['k'], child.attrib['v']))
+        elif child.tag == 'nd':
+            refs.append(child.attrib['ref'])
+        elif child.tag == 'member':
+            members.append((child.attrib['type'], child.attrib['ref'], child.attrib.get('role', '')))
+    return OsmElement(elem.tag, dict(elem.attrib), tags, refs, members)
+
+
+def iter_elements(osm_file, tags=ELEMENT_TYPES, parser=DEFAULT_PARSER,
+                  read_size=READ_SIZE):
+    """Yield an OsmElement for each top level element of the right type of tag.
+
+    osm_file can be a path (of a plain, .bz2 or .gz file) or a file-like object with a read method."""
+    try:
+        backend = PARSERS[parser]
+    except KeyError:
+        raise ValueError("Unknown parser '{0}', expected one of {1}".format(parser, sorted(PARSERS)))
+    if not hasattr(osm_file, 'read') and compression_of(osm_file):
+        return _iter_compressed(backend, osm_file, frozenset(tags), read_size)
+    return backend(osm_file, frozenset(tags), read_size)
+
+
+def iter_changes(osc_file, tags=ELEMENT_TYPES, read_size=READ_SIZE):
+    """Yield (action, OsmElement) for each element of an osmChange file, in file order.
+
+    action is "create", "modify" or "delete". Elements in delete blocks may only carry their id
+    and version attributes. osc_file can be a path (also .bz2 or .gz) or a file-like object."""
+    backend = partial(_iter_expat, actions=True)
+    if not hasattr(osc_file, 'read') and compression_of(osc_file):
+        return _iter_compressed(backend, osc_file, frozenset(tags), read_size)
+    return backend(osc_file, frozenset(tags), read_size)
+
+
+def _iter_compressed(backend, osm_path, tags, read_size):
+    with open_compressed(osm_path) as f:
+        for element in backend(f, tags, read_size):
+            yield element
+
+
+def _iter_etree(osm_file, tags, read_size):
+    for elem in get_element(osm_file, tags):
+        yield from_etree(elem)
+
+
+def _iter_lxml(osm_file, tags, read_size):
+    if lxml_etree is None:
+        raise ImportError("The lxml parser backend needs the lxml package")
+
+    for _, elem in lxml_etree.iterparse(osm_file, events=('end',), tag=tuple(tags)):
+        yield from_etree(elem)
+        # Drop the element and the already processed siblings that lxml keeps on the root
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def _iter_expat(osm_file, tags, read_size, actions=False):
+    done = []
+    # [element being built, append of its tags list, append of its refs list,
+    #  append of its members list (relations only)]
+    current = [None, None, None, None]
+    # The osmChange block the parser is in, with actions=True
+    action = [None]
+
+    # The handlers are closures rather than methods: they run once per XML tag, so every
+    # attribute lookup saved here shows up in the elements/sec
+    def start(name, attrs):
+        if current[0] is None:
+            if name in tags:
+                if name == 'relation':
+                    element = OsmElement(name, attrs, [], [], [], parser.CurrentByteIndex)
+                    current[:] = (element, element.tags.append, element.refs.append,
+                                  element.members.append)
+                else:
+                    element = OsmElement(name, attrs, [], [], (), parser.CurrentByteIndex)
+                    current[:] = element, element.tags.append, element.refs.append, None
+            elif actions and name in ACTIONS:
+                action[0] = name
+        elif name == 'tag':
+            current[1]((attrs['k'], attrs['v']))
+        elif name == 'nd':
+            current[2](attrs['ref'])
+        elif name == 'member':
+            current[3]((attrs['type'], attrs['ref'], attrs.get('role', '')))
+
+    def end(name):
+        element = current[0]
+        if element is not None and name == element.tag:
+            done.append((action[0], element) if actions else element)
+            current[0] = None
+
+    parser = expat.ParserCreate()
+    # Keep the values utf-8 encoded instead of decoding every one of them to unicode
+    parser.returns_unicode = False
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+
+    opened = not hasattr(osm_file, 'read')
+    f = open(osm_file, 'rb') if opened else osm_file
+    try:
+        while True:
+            data = f.read(read_size)
+            parser.Parse(data, not data)
+            for element in done:
+                yield element
+            del done[:]
+            if not data:
+                break
+    finally:
+        if opened:
+            f.close()
+
+
+PARSERS = {
+    'expat': _iter_expat,
+    'lxml': _iter_lxml,
+    'etree': _iter_etree,
+}
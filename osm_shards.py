@@ -0,0 +1,119 @@
+"""
+Split an OSM XML file into byte-range shards so that several processes can parse it at once.
+
+Every shard starts on a top-level <node>, <way> or <relation> tag and ends right before the next
+shard starts, so each one can be parsed on its own once it is wrapped in an <osm> root. Reading the
+shards one after another visits exactly the same elements, in the same order, as a single pass over
+the whole file.
+"""
+import os
+import re
+
+# Top-level element openings. "<nd" and "<member" never match since the name must be followed by
+# whitespace, and only top-level elements are called node/way/relation.
+TOP_LEVEL_TAG = re.compile(r'<(?:node|way|relation)[\s/>]')
+END_OF_ROOT = '</osm>'
+
+SHARD_PREFIX = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n'
+SHARD_SUFFIX = '\n</osm>\n'
+
+SCAN_SIZE = 1 << 16
+READ_SIZE = 1 << 20
+
+
+def find_element_start(osm_file, offset, scan_size=SCAN_SIZE):
+    """Return the offset of the first top-level element starting at or after offset, or None"""
+    osm_file.seek(offset)
+    # Keep a small overlap between reads so a tag split across two reads is still found
+    overlap = ''
+    position = offset
+    while True:
+        data = osm_file.read(scan_size)
+        if not data:
+            return None
+        window = overlap + data
+        m = TOP_LEVEL_TAG.search(window)
+        if m:
+            return position - len(overlap) + m.start()
+        overlap = window[-16:]
+        position += len(data)
+
+
+def find_end_of_elements(osm_file, file_size, scan_size=SCAN_SIZE):
+    """Return the offset of the closing </osm> tag, which is where the last shard has to stop"""
+    start = max(0, file_size - scan_size)
+    osm_file.seek(start)
+    tail = osm_file.read()
+    index = tail.rfind(END_OF_ROOT)
+    if index == -1:
+        return file_size
+    return start + index
+
+
+def find_shards(osm_path, shards):
+    """Return a list of (start, end) byte ranges that split osm_path into at most `shards` pieces"""
+    file_size = os.path.getsize(osm_path)
+    with open(osm_path, 'rb') as osm_file:
+        first = find_element_start(osm_file, 0)
+        if first is None:
+            return []
+        last = find_end_of_elements(osm_file, file_size)
+        step = max(1, (last - first) // max(1, shards))
+
+        starts = [first]
+        for i in range(1, shards):
+            start = find_element_start(osm_file, first + i * step)
+            if start is None or start >= last:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+
+    ends = starts[1:] + [last]
+    return zip(starts, ends)
+
+
+def remainder(osm_path, start):
+    """Return a ShardReader over the elements of osm_path from offset start (e.g. to resume)"""
+    with open(osm_path, 'rb') as osm_file:
+        end = find_end_of_elements(osm_file, os.path.getsize(osm_path))
+    return ShardReader(osm_path, start, end)
+
+
+class ShardReader(object):
+    """File-like object that reads one shard wrapped in an <osm> root element.
+
+    An offset in the stream it returns is at base_offset + offset in the file."""
+
+    def __init__(self, osm_path, start, end, read_size=READ_SIZE):
+        self.base_offset = start - len(SHARD_PREFIX)
+        self._file = open(osm_path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._read_size = read_size
+        self._pending = [SHARD_PREFIX]
+        self._suffix_sent = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._read_size
+        if self._pending:
+            return self._pending.pop()
+        if self._remaining > 0:
+            data = self._file.read(min(size, self._remaining))
+            if data:
+                self._remaining -= len(data)
+                return data
+            self._remaining = 0
+        if not self._suffix_sent:
+            self._suffix_sent = True
+            return SHARD_SUFFIX
+        return ''
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
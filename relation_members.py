@@ -0,0 +1,77 @@
+"""Compact storage of the members of a relation.
+
+A route or boundary relation can have tens of thousands of members, so instead of one dict (or
+tuple) per member a relation's members are kept in three parallel typed arrays: the member type as
+a small int code, the ref as a 64-bit int and the role as an int code into a RoleDictionary, which
+is shared by all relations since the same few roles ("outer", "inner", "stop", ...) come back again
+and again. The rows are only spelled out when they are written.
+"""
+from array import array
+from itertools import count, izip
+
+from int_arrays import int64_array
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+MEMBER_TYPE_CODES = dict((member_type, code) for code, member_type in enumerate(MEMBER_TYPES))
+
+
+class RoleDictionary(object):
+    """Role string <-> int code, codes handed out in the order the roles are first seen"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, role):
+        code = self.codes.get(role)
+        if code is None:
+            code = self.codes[role] = len(self.values)
+            self.values.append(role)
+        return code
+
+    def __len__(self):
+        return len(self.values)
+
+
+ROLES = RoleDictionary()
+
+
+class RelationMembers(object):
+    """The (type, ref, role) members of one relation in typed arrays"""
+
+    __slots__ = ('types', 'refs', 'roles', 'role_values')
+
+    def __init__(self, members=(), roles=ROLES):
+        self.types = array('b')
+        self.refs = int64_array()
+        self.roles = array('i')
+        self.role_values = roles.values
+        code = roles.code
+        for member_type, ref, role in members:
+            try:
+                self.types.append(MEMBER_TYPE_CODES[member_type])
+            except KeyError:
+                raise ValueError("Unknown member type '{0}'".format(member_type))
+            self.refs.append(int(ref))
+            self.roles.append(code(role))
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __iter__(self):
+        """Yield the (type, ref, role) of each member"""
+        role_values = self.role_values
+        for type_code, ref, role_code in izip(self.types, self.refs, self.roles):
+            yield MEMBER_TYPES[type_code], ref, role_values[role_code]
+
+    def rows(self, relation_id):
+        """Yield the (id, member_type, member_id, role, position) rows of the members"""
+        return ((relation_id, member_type, ref, role, position)
+                for (member_type, ref, role), position in izip(self, count()))
+
+    def refs_of(self, member_type):
+        """Yield the refs of the members of one type"""
+        type_code = MEMBER_TYPE_CODES[member_type]
+        for code, ref in izip(self.types, self.refs):
+            if code == type_code:
+                yield ref
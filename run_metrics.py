@@ -0,0 +1,242 @@
+"""
+Instrumentation of a process_map run: where the time goes and what happens to the elements.
+
+RunMetrics keeps
+- the seconds spent in each stage (read, parse, area, audit, shape, cleaners, validate, write,
+  geometry)
+- elements in and out per element type, and dropped elements by the tag key whose cleaner
+  dropped them (e.g. "addr:postcode" for a postcode outside San Jose), or by the step before the
+  cleaning that left them out ("duplicate" when merging inputs, "outside area"); elements in
+  are always elements out plus dropped
+- rows written per output table
+- the hits, misses and time of each cleaning rule's cache
+
+It prints a progress line with the throughput and ETA every few seconds while the input is read,
+can be merged with the metrics of other shards, and is written as JSON at the end of the run.
+"""
+from collections import defaultdict
+import cProfile
+import json
+import sys
+import time
+
+PROGRESS_SECONDS = 10
+# How many elements go by between two looks at the clock for the progress line
+PROGRESS_CHECK_EVERY = 1000
+
+STAGES = ('read', 'parse', 'area', 'audit', 'shape', 'cleaners', 'validate', 'write', 'geometry')
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024.0
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+class RunMetrics(object):
+    """Stage timers, element counters and progress reporting for one run (or shard)"""
+
+    def __init__(self, total_bytes=None, progress_every=PROGRESS_SECONDS, stream=sys.stderr,
+                 clock=time.time):
+        self.total_bytes = total_bytes
+        self.progress_every = progress_every
+        self.stream = stream
+        self.clock = clock
+        self.start_time = clock()
+        self.end_time = None
+        self.bytes_read = 0
+        self.stage_seconds = defaultdict(float)
+        self.elements_in = defaultdict(int)
+        self.elements_out = defaultdict(int)
+        self.dropped = defaultdict(int)
+        self.rows_written = defaultdict(int)
+        self.cleaners = {}
+        self._next_progress = self.start_time + progress_every if progress_every else None
+        self._until_check = PROGRESS_CHECK_EVERY
+
+    def add_time(self, stage, seconds):
+        self.stage_seconds[stage] += seconds
+
+    def element_in(self, tag):
+        self.elements_in[tag] += 1
+        if self._next_progress is not None:
+            self._until_check -= 1
+            if self._until_check <= 0:
+                self._until_check = PROGRESS_CHECK_EVERY
+                self.maybe_report()
+
+    def element_out(self, tag):
+        self.elements_out[tag] += 1
+
+    def element_dropped(self, reason, count=1):
+        self.dropped[reason] += count
+
+    def add_filtered(self, reason, counts):
+        """Count elements left out before they reached write_elements: counts is {tag: count}, as
+        in osm_merge.ExtractMerger.duplicates or spatial_filter.SpatialFilter.dropped"""
+        for tag, count in counts.iteritems():
+            self.elements_in[tag] += count
+            self.dropped[reason] += count
+
+    def rows(self, table, count=1):
+        self.rows_written[table] += count
+
+    def add_cleaner_stats(self, before, after):
+        """Add the difference of two CleaningRules.stats() snapshots"""
+        for key, stats in after.iteritems():
+            previous = before.get(key, {})
+            totals = self.cleaners.setdefault(key, {'hits': 0, 'misses': 0, 'seconds': 0.0})
+            for field in totals:
+                totals[field] += stats[field] - previous.get(field, 0)
+
+    def merge(self, other):
+        """Add the counts and timings of another RunMetrics (e.g. of a shard)"""
+        self.bytes_read += other.bytes_read
+        for mine, theirs in ((self.stage_seconds, other.stage_seconds),
+                             (self.elements_in, other.elements_in),
+                             (self.elements_out, other.elements_out),
+                             (self.dropped, other.dropped),
+                             (self.rows_written, other.rows_written)):
+            for key, value in theirs.iteritems():
+                mine[key] += value
+        for key, stats in other.cleaners.iteritems():
+            self.add_cleaner_stats({}, {key: stats})
+
+    def maybe_report(self):
+        """Print the progress line if progress_every seconds went by since the last one"""
+        now = self.clock()
+        if self._next_progress is not None and now >= self._next_progress:
+            self._next_progress = now + self.progress_every
+            self.report_progress(now)
+
+    def report_progress(self, now=None):
+        if self.stream is None:
+            return
+        elapsed = max((now or self.clock()) - self.start_time, 1e-9)
+        rate = self.bytes_read / elapsed
+        line = '[progress] {0} read, {1}/s, {2} elements'.format(
+            format_bytes(self.bytes_read), format_bytes(rate), sum(self.elements_in.values()))
+        if self.total_bytes:
+            done = min(1.0, float(self.bytes_read) / self.total_bytes)
+            line += ', {0:.1f}%'.format(100 * done)
+            if rate > 0:
+                line += ', ETA {0}'.format(
+                    format_seconds(max(0, self.total_bytes - self.bytes_read) / rate))
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def finish(self):
+        self.end_time = self.clock()
+
+    def to_dict(self):
+        elapsed = (self.end_time or self.clock()) - self.start_time
+        stage_seconds = dict(self.stage_seconds)
+        stage_seconds['cleaners'] = sum(stats['seconds'] for stats in self.cleaners.itervalues())
+        return {
+            'input_bytes': self.total_bytes,
+            'bytes_read': self.bytes_read,
+            'elapsed_seconds': elapsed,
+            'bytes_per_sec': self.bytes_read / elapsed if elapsed > 0 else None,
+            'elements_in': dict(self.elements_in),
+            'elements_out': dict(self.elements_out),
+            'dropped': dict(self.dropped),
+            'rows_written': dict(self.rows_written),
+            # Stage times are summed over all worker processes in a parallel run; "parse"
+            # includes "read", "area" includes "parse" (the spatial filter sees the elements as
+            # they are parsed), "shape" includes "cleaners" (the time of the cache misses)
+            'stage_seconds': stage_seconds,
+            'cleaners': self.cleaners,
+        }
+
+
+class NullMetrics(object):
+    """Takes the calls of a RunMetrics in runs without metrics and does nothing with them"""
+
+    @staticmethod
+    def clock():
+        return 0.0
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def element_in(self, tag):
+        pass
+
+    def element_out(self, tag):
+        pass
+
+    def element_dropped(self, reason, count=1):
+        pass
+
+    def rows(self, table, count=1):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def write_json(metrics, path):
+    """Write the summary of a RunMetrics as JSON"""
+    with open(path, 'w') as f:
+        json.dump(metrics.to_dict(), f, indent=2, sort_keys=True)
+
+
+class CountingReader(object):
+    """File-like wrapper that adds the bytes and time of every read to a RunMetrics"""
+
+    def __init__(self, f, metrics):
+        self.f = f
+        self.metrics = metrics
+
+    def read(self, size=-1):
+        metrics = self.metrics
+        start = metrics.clock()
+        data = self.f.read(size)
+        metrics.add_time('read', metrics.clock() - start)
+        metrics.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def timed_iter(iterable, metrics, stage):
+    """Yield the items of iterable, adding the time spent getting each one to stage"""
+    clock = metrics.clock
+    iterator = iter(iterable)
+    while True:
+        start = clock()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metrics.add_time(stage, clock() - start)
+            return
+        metrics.add_time(stage, clock() - start)
+        yield item
+
+
+def make_metrics(metrics, total_bytes=None, progress_every=PROGRESS_SECONDS):
+    """Return the RunMetrics for process_map's metrics argument: False, True or a RunMetrics"""
+    if isinstance(metrics, RunMetrics):
+        if metrics.total_bytes is None:
+            metrics.total_bytes = total_bytes
+        return metrics
+    if metrics:
+        return RunMetrics(total_bytes, progress_every)
+    return None
+
+
+def profiled(function, path, *args, **kwargs):
+    """Run function(*args, **kwargs) under cProfile and dump the stats to path (pstats format)"""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
@@ -0,0 +1,270 @@
+"""
+Keep only the part of a map inside an area (a bounding box or a polygon).
+
+Nodes are tested against the area straight after parsing, before they are audited or shaped. The
+ids of the kept nodes go into a sorted 64-bit int array, and a way is kept if at least one of its
+nodes was kept (the "simple" strategy of osmium extract: the nodes of kept ways outside the area
+are not added back). Likewise a relation is kept if one of its node, way or relation members was
+kept; members of kept relations are not added back either. Nodes have to come before the ways,
+and ways before the relations, as they do in OSM files. A relation that is a member of a relation
+listed before it is not known to be kept at that point, so only the members that come earlier in
+the file count.
+
+Polygons are tested through a grid laid over their bounding box: cells entirely inside or outside
+the polygon answer at once, and only points in cells crossed by an edge are ray cast, against the
+edges of their grid row. Polygons can have holes and several outer rings (even-odd rule), and can
+be read from GeoJSON or from the osmosis .poly files used for OSM extracts. Points exactly on an
+edge of a polygon may fall on either side; a BBox includes its edges.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import heapq
+from itertools import islice
+import json
+
+from int_arrays import int64_array
+
+GRID_SIZE = 64
+# Kept ids that come out of order are sorted this many at a time, then merged
+SORT_CHUNK = 1 << 16
+
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+
+class BBox(object):
+    """Axis aligned area between two latitudes and two longitudes"""
+
+    def __init__(self, min_lat, min_lon, max_lat, max_lon):
+        self.min_lat, self.min_lon = float(min_lat), float(min_lon)
+        self.max_lat, self.max_lon = float(max_lat), float(max_lon)
+
+    def contains(self, lat, lon):
+        return self.min_lat <= lat <= self.max_lat and self.min_lon <= lon <= self.max_lon
+
+
+class Polygon(object):
+    """Area inside one or more rings of (lat, lon) points, with a grid index for contains"""
+
+    def __init__(self, rings, grid_size=GRID_SIZE):
+        edges = []
+        for ring in rings:
+            points = [(float(lat), float(lon)) for lat, lon in ring]
+            for (lat1, lon1), (lat2, lon2) in zip(points, points[1:] + points[:1]):
+                if (lat1, lon1) != (lat2, lon2):
+                    edges.append((lat1, lon1, lat2, lon2))
+        if not edges:
+            raise ValueError("The polygon has no edges")
+
+        lats = [edge[0] for edge in edges] + [edge[2] for edge in edges]
+        lons = [edge[1] for edge in edges] + [edge[3] for edge in edges]
+        self.bbox = BBox(min(lats), min(lons), max(lats), max(lons))
+        self.grid_size = n = grid_size
+        self.cell_lat = (self.bbox.max_lat - self.bbox.min_lat) / n or 1e-9
+        self.cell_lon = (self.bbox.max_lon - self.bbox.min_lon) / n or 1e-9
+
+        # The edges that can cross a horizontal ray in each row of the grid
+        self.rows = [[] for _ in range(n)]
+        self.cells = bytearray(n * n)
+        for edge in edges:
+            lat1, lon1, lat2, lon2 = edge
+            first_row, last_row = sorted((self._row(lat1), self._row(lat2)))
+            first_column, last_column = sorted((self._column(lon1), self._column(lon2)))
+            for row in range(first_row, last_row + 1):
+                self.rows[row].append(edge)
+                # Every cell of the edge's bounding box may be crossed by it
+                for column in range(first_column, last_column + 1):
+                    self.cells[row * n + column] = BOUNDARY
+
+        for row in range(n):
+            center_lat = self.bbox.min_lat + (row + 0.5) * self.cell_lat
+            for column in range(n):
+                if self.cells[row * n + column] != BOUNDARY:
+                    center_lon = self.bbox.min_lon + (column + 0.5) * self.cell_lon
+                    if _crosses_odd(self.rows[row], center_lat, center_lon):
+                        self.cells[row * n + column] = INSIDE
+
+    def _row(self, lat):
+        return min(self.grid_size - 1, max(0, int((lat - self.bbox.min_lat) / self.cell_lat)))
+
+    def _column(self, lon):
+        return min(self.grid_size - 1, max(0, int((lon - self.bbox.min_lon) / self.cell_lon)))
+
+    def contains(self, lat, lon):
+        if not self.bbox.contains(lat, lon):
+            return False
+        row = self._row(lat)
+        state = self.cells[row * self.grid_size + self._column(lon)]
+        if state == BOUNDARY:
+            return _crosses_odd(self.rows[row], lat, lon)
+        return state == INSIDE
+
+    @classmethod
+    def from_geojson(cls, path, grid_size=GRID_SIZE):
+        """Read the Polygon and MultiPolygon geometries of a GeoJSON file"""
+        with open(path) as f:
+            data = json.load(f)
+        rings = []
+        for geometry in _geojson_geometries(data):
+            if geometry['type'] == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry['type'] == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+            for polygon in polygons:
+                # GeoJSON positions are [lon, lat]
+                rings.extend([(point[1], point[0]) for point in ring] for ring in polygon)
+        return cls(rings, grid_size)
+
+    @classmethod
+    def from_poly(cls, path, grid_size=GRID_SIZE):
+        """Read an osmosis polygon filter file (.poly); holes are the sections named !..."""
+        rings = []
+        with open(path) as f:
+            lines = [line.strip() for line in f]
+        ring = None
+        # The first line is the name of the polygon
+        for line in lines[1:]:
+            if not line:
+                continue
+            if ring is None:
+                if line == 'END':
+                    break
+                ring = []
+            elif line == 'END':
+                rings.append(ring)
+                ring = None
+            else:
+                lon, lat = line.split()[:2]
+                ring.append((float(lat), float(lon)))
+        return cls(rings, grid_size)
+
+
+def _geojson_geometries(data):
+    if data['type'] == 'FeatureCollection':
+        for feature in data['features']:
+            for geometry in _geojson_geometries(feature):
+                yield geometry
+    elif data['type'] == 'Feature':
+        if data.get('geometry'):
+            yield data['geometry']
+    elif data['type'] == 'GeometryCollection':
+        for geometry in data['geometries']:
+            yield geometry
+    else:
+        yield data
+
+
+def _crosses_odd(edges, lat, lon):
+    """True if a ray from (lat, lon) towards increasing lon crosses an odd number of edges"""
+    inside = False
+    for lat1, lon1, lat2, lon2 in edges:
+        if (lat1 > lat) != (lat2 > lat):
+            if lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+                inside = not inside
+    return inside
+
+
+def make_area(area):
+    """Return the area for process_map's area argument: a BBox or Polygon, a (min_lat, min_lon,
+    max_lat, max_lon) tuple, or the path of a .poly or GeoJSON file"""
+    if hasattr(area, 'contains'):
+        return area
+    if isinstance(area, basestring):
+        if area.endswith('.poly'):
+            return Polygon.from_poly(area)
+        return Polygon.from_geojson(area)
+    return BBox(*area)
+
+
+class SpatialFilter(object):
+    """Filter a stream of OsmElements down to an area"""
+
+    def __init__(self, area):
+        self.area = make_area(area)
+        self.kept_nodes = int64_array()
+        self.kept_ways = int64_array()
+        self.kept_relations = int64_array()
+        self.kept = defaultdict(int)
+        self.dropped = defaultdict(int)
+        self._kept_ids = {'node': self.kept_nodes, 'way': self.kept_ways,
+                          'relation': self.kept_relations}
+        # How many ids at the start of each kept_* array are known to be sorted
+        self._sorted_upto = {'node': 0, 'way': 0, 'relation': 0}
+
+    def filter(self, elements):
+        """Yield the nodes inside the area, the ways with one of those nodes, the relations with one
+        of the kept elements as member and everything else"""
+        contains = self.area.contains
+        keep_node = self.kept_nodes.append
+        keep_way = self.kept_ways.append
+        keep_relation = self.kept_relations.append
+        for element in elements:
+            tag = element.tag
+            if tag == 'node':
+                attrib = element.attrib
+                if contains(float(attrib['lat']), float(attrib['lon'])):
+                    keep_node(int(attrib['id']))
+                else:
+                    self.dropped[tag] += 1
+                    continue
+            elif tag == 'way':
+                if not self.has_kept_node(element.refs):
+                    self.dropped[tag] += 1
+                    continue
+                keep_way(int(element.attrib['id']))
+            elif tag == 'relation':
+                if not self.has_kept_member(element.members):
+                    self.dropped[tag] += 1
+                    continue
+                keep_relation(int(element.attrib['id']))
+            self.kept[tag] += 1
+            yield element
+
+    def has_kept_node(self, refs):
+        return _has_any(self._sorted_ids('node'), refs)
+
+    def has_kept_member(self, members):
+        """True if one of the (type, ref, role) members of a relation was kept"""
+        for member_type, ref, _ in members:
+            if _has_any(self._sorted_ids(member_type), (ref,)):
+                return True
+        return False
+
+    def _sorted_ids(self, kind):
+        """Return the kept ids of one element type, sorting the ones added since the last call"""
+        ids = self._kept_ids[kind]
+        if self._sorted_upto[kind] < len(ids):
+            _sort_tail(ids, self._sorted_upto[kind])
+            self._sorted_upto[kind] = len(ids)
+        return ids
+
+
+def _sort_tail(ids, start):
+    """Sort the array ids in place, given that ids[:start] is sorted already.
+
+    Only the ids from start on are looked at while they are in order. Past that, the rest is
+    sorted in chunks of SORT_CHUNK and merged with the sorted part into a new array, so there is
+    never a Python list of all the ids."""
+    length = len(ids)
+    i = max(start, 1)
+    while i < length and ids[i - 1] <= ids[i]:
+        i += 1
+    if i >= length:
+        return
+    chunks = [int64_array(sorted(ids[j:j + SORT_CHUNK])) for j in xrange(i, length, SORT_CHUNK)]
+    # In place: filter holds on to the array's append method
+    ids[:] = int64_array(heapq.merge(islice(ids, i), *chunks))
+
+
+def _has_any(ids, refs):
+    """True if one of refs is in the sorted array ids"""
+    length = len(ids)
+    for ref in refs:
+        ref = int(ref)
+        i = bisect_left(ids, ref)
+        if i < length and ids[i] == ref:
+            return True
+    return False
@@ -0,0 +1,224 @@
+"""
+Write the shaped rows straight into a SQLite database instead of going through the csv files.
+
+SQLiteSink hands out one writer per table with the same writerow/writerows interface as
+UnicodeDictWriter, so process_map can use either. Rows are buffered and inserted with executemany
+inside large transactions, and the indexes are only built once everything is loaded.
+
+An existing database can also be updated in place (overwrite=False): versions() and delete() look
+up and remove the rows of given ids, e.g. to apply an osmChange file. sync() commits what has been
+written so far and truncate() rolls the tables back to such a point, to resume an interrupted load.
+"""
+import csv
+import itertools
+import os
+import sqlite3
+
+BATCH_SIZE = 10000
+TRANSACTION_ROWS = 500000
+
+# Bulk load defaults: no rollback journal and no fsync, the database is rebuilt from scratch
+# anyway if the load dies half way
+JOURNAL_MODE = 'OFF'
+SYNCHRONOUS = 'OFF'
+CACHE_SIZE = -262144  # negative means KiB, so 256 MiB
+# Updates of an existing database have to be able to roll back
+UPDATE_JOURNAL_MODE = 'WAL'
+UPDATE_SYNCHRONOUS = 'NORMAL'
+# Ids per "IN (...)" lookup, below SQLite's limit of 999 parameters
+LOOKUP_BATCH = 500
+
+COLUMN_TYPES = {
+    'id': 'INTEGER',
+    'lat': 'REAL',
+    'lon': 'REAL',
+    'user': 'TEXT',
+    'uid': 'INTEGER',
+    'version': 'TEXT',
+    'changeset': 'INTEGER',
+    'timestamp': 'TEXT',
+    'key': 'TEXT',
+    'value': 'TEXT',
+    'type': 'TEXT',
+    'node_id': 'INTEGER',
+    'position': 'INTEGER',
+    'min_lat': 'REAL',
+    'min_lon': 'REAL',
+    'max_lat': 'REAL',
+    'max_lon': 'REAL',
+    'missing_nodes': 'INTEGER',
+    'wkt': 'TEXT',
+    'member_type': 'TEXT',
+    'member_id': 'INTEGER',
+    'role': 'TEXT',
+}
+
+# (table, column) pairs indexed at the end of the load
+INDEXES = [
+    ('nodes', 'id'),
+    ('nodes_tags', 'id'),
+    ('ways', 'id'),
+    ('ways_tags', 'id'),
+    ('ways_nodes', 'id'),
+    ('ways_nodes', 'node_id'),
+    ('ways_geometry', 'id'),
+    ('relations', 'id'),
+    ('relations_tags', 'id'),
+    ('relations_members', 'id'),
+    ('relations_members', 'member_id'),
+]
+
+
+class SQLiteTableWriter(object):
+    """Buffer rows for one table and insert them in batches"""
+
+    def __init__(self, sink, table, fields, batch_size=BATCH_SIZE):
+        self.sink = sink
+        self.fields = fields
+        self.batch_size = batch_size
+        self.sql = "INSERT INTO {0} ({1}) VALUES ({2})".format(
+            table, ", ".join(fields), ", ".join("?" * len(fields)))
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(tuple([row[field] for field in self.fields]))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def writetuples(self, rows, encode=True):
+        """Write rows that are already tuples in the order of fields.
+
+        encode is accepted for compatibility with UnicodeDictWriter; sqlite3 takes both str and
+        unicode values as they are."""
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.sink.insert(self.sql, self.rows)
+            self.rows = []
+
+
+class SQLiteSink(object):
+    """SQLite database with one table per output, loaded in bulk"""
+
+    def __init__(self, db_path, tables, fields, journal_mode=JOURNAL_MODE, synchronous=SYNCHRONOUS,
+                 cache_size=CACHE_SIZE, batch_size=BATCH_SIZE, transaction_rows=TRANSACTION_ROWS,
+                 overwrite=True):
+        if overwrite and os.path.exists(db_path):
+            os.remove(db_path)
+
+        self.connection = sqlite3.connect(db_path, isolation_level=None)
+        # The parsers may hand over utf-8 encoded str values, which sqlite3 only accepts this way
+        self.connection.text_factory = str
+        self.connection.execute("PRAGMA journal_mode = {0}".format(journal_mode))
+        self.connection.execute("PRAGMA synchronous = {0}".format(synchronous))
+        self.connection.execute("PRAGMA cache_size = {0}".format(int(cache_size)))
+
+        self.tables = []
+        self.writers = []
+        self.batch_size = batch_size
+        self.transaction_rows = transaction_rows
+        self.pending_rows = 0
+        for table, table_fields in zip(tables, fields):
+            self.add_table(table, None, table_fields)
+        self.connection.execute("BEGIN")
+
+    def add_table(self, table, path, fields):
+        """Create one more table and return its writer (path is only used by the csv output)"""
+        columns = ", ".join("{0} {1}".format(field, COLUMN_TYPES.get(field, 'TEXT'))
+                            for field in fields)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {0} ({1})".format(table, columns))
+        writer = SQLiteTableWriter(self, table, fields, self.batch_size)
+        self.tables.append(table)
+        self.writers.append(writer)
+        return writer
+
+    def insert(self, sql, rows):
+        self.connection.executemany(sql, rows)
+        self.pending_rows += len(rows)
+        if self.pending_rows >= self.transaction_rows:
+            self.connection.execute("COMMIT")
+            self.connection.execute("BEGIN")
+            self.pending_rows = 0
+
+    def versions(self, table, ids):
+        """Return {id: version} of the rows of table with one of ids"""
+        ids = list(ids)
+        versions = {}
+        for start in xrange(0, len(ids), LOOKUP_BATCH):
+            batch = ids[start:start + LOOKUP_BATCH]
+            sql = "SELECT id, version FROM {0} WHERE id IN ({1})".format(
+                table, ", ".join("?" * len(batch)))
+            versions.update(self.connection.execute(sql, batch))
+        return versions
+
+    def has_table(self, table):
+        return self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                                       "name = ?", (table,)).fetchone() is not None
+
+    def referencing_ids(self, table, column, ids):
+        """Return the set of ids of the rows of table whose column holds one of ids"""
+        ids = list(ids)
+        referencing = set()
+        for start in xrange(0, len(ids), LOOKUP_BATCH):
+            batch = ids[start:start + LOOKUP_BATCH]
+            sql = "SELECT DISTINCT id FROM {0} WHERE {1} IN ({2})".format(
+                table, column, ", ".join("?" * len(batch)))
+            referencing.update(row[0] for row in self.connection.execute(sql, batch))
+        return referencing
+
+    def delete(self, table, ids):
+        """Delete the rows of table with one of ids (flush the table's writer first)"""
+        self.connection.executemany("DELETE FROM {0} WHERE id = ?".format(table),
+                                    [(element_id,) for element_id in ids])
+
+    def sync(self):
+        """Commit everything written so far and return the last rowid of each table"""
+        for writer in self.writers:
+            writer.flush()
+        self.connection.execute("COMMIT")
+        sizes = [self.connection.execute("SELECT max(rowid) FROM {0}".format(table)).fetchone()[0]
+                 or 0 for table in self.tables]
+        self.connection.execute("BEGIN")
+        self.pending_rows = 0
+        return sizes
+
+    def truncate(self, sizes):
+        """Delete the rows added after sync() returned sizes"""
+        for table, size in zip(self.tables, sizes):
+            self.connection.execute("DELETE FROM {0} WHERE rowid > ?".format(table), (size,))
+
+    def load_csv(self, index, path):
+        """Insert the rows of a headerless csv file (e.g. from a shard) into table number index"""
+        writer = self.writers[index]
+        with open(path, 'rb') as csv_file:
+            reader = csv.reader(csv_file)
+            while True:
+                batch = list(itertools.islice(reader, writer.batch_size))
+                if not batch:
+                    break
+                writer.writetuples(batch)
+
+    def create_indexes(self):
+        for table, column in INDEXES:
+            if table in self.tables:
+                self.connection.execute("CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {0} ({1})"
+                                        .format(table, column))
+
+    def close(self):
+        """Flush the remaining rows, commit and build the indexes"""
+        for writer in self.writers:
+            writer.flush()
+        self.connection.execute("COMMIT")
+        self.create_indexes()
+        self.connection.close()
+
+    def abort(self):
+        """Close the database without flushing or indexing, e.g. after an error"""
+        self.connection.close()
@@ -0,0 +1,174 @@
+"""
+Threads that overlap the input and output of process_map with the parsing and shaping.
+
+- ThreadedReader reads the input in large chunks in its own thread and hands them to the parser
+  through a bounded queue, so the parser never waits on the disk while there is data read ahead.
+- ThreadedWriter collects the rows of one output table in batches and writes them in its own
+  thread, so flushing a csv file does not stall the parser.
+
+The queues are bounded, so memory stays at most QUEUE_DEPTH chunks (or batches) per thread
+whatever the size of the input. An error in one of the threads is raised again in the main
+thread by the next read or write.
+"""
+import Queue
+import sys
+import threading
+
+READ_SIZE = 4 << 20
+BATCH_ROWS = 4096
+QUEUE_DEPTH = 8
+
+_DONE = object()
+
+
+def _reraise(exc_info):
+    raise exc_info[0], exc_info[1], exc_info[2]
+
+
+class ThreadedReader(object):
+    """File-like object reading f ahead in a background thread.
+
+    read() returns the chunks as the thread read them (up to size bytes), which is all the parser
+    backends need."""
+
+    def __init__(self, f, read_size=READ_SIZE, depth=QUEUE_DEPTH):
+        self.f = f
+        self.read_size = read_size
+        self.queue = Queue.Queue(depth)
+        self.error = None
+        self._buffer = b''
+        self._eof = False
+        self._closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='osm-reader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        # Give up when the consumer is gone instead of blocking on a full queue forever
+        while not self._closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            while True:
+                data = self.f.read(self.read_size)
+                if not data:
+                    break
+                if not self._put(data):
+                    return
+        except Exception:
+            self.error = sys.exc_info()
+        self._put(_DONE)
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self._buffer]
+            while not self._eof:
+                chunks.append(self._next_chunk())
+            self._buffer = b''
+            return b''.join(chunks)
+
+        if not self._buffer and not self._eof:
+            self._buffer = self._next_chunk()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _next_chunk(self):
+        item = self.queue.get()
+        if item is _DONE:
+            self._eof = True
+            if self.error is not None:
+                _reraise(self.error)
+            return b''
+        return item
+
+    def close(self):
+        self._closed.set()
+        self.thread.join()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ThreadedWriter(object):
+    """Wrap a writer with a writetuples method (UnicodeDictWriter and the like) so that its rows
+    are written in batches of batch_rows by a background thread.
+
+    Rows are copied into the batch, so writetuples can be given iterators. close() writes the
+    last batch and waits for the thread, it does not close the underlying file."""
+
+    def __init__(self, writer, batch_rows=BATCH_ROWS, depth=QUEUE_DEPTH):
+        self.writer = writer
+        self.batch_rows = batch_rows
+        self.queue = Queue.Queue(depth)
+        self.error = None
+        self._batch = []
+        self._encode = True
+        self._aborted = False
+        self.thread = threading.Thread(target=self._run, name='osm-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                self.queue.task_done()
+                return
+            if self.error is None and not self._aborted:
+                rows, encode = item
+                try:
+                    self.writer.writetuples(rows, encode)
+                except Exception:
+                    # Keep taking batches off the queue so the main thread does not block
+                    self.error = sys.exc_info()
+            self.queue.task_done()
+
+    def writetuples(self, rows, encode=True):
+        if encode != self._encode:
+            # Batches hold rows of a single kind, the order of the rows has to stay the same
+            self.flush()
+            self._encode = encode
+        batch = self._batch
+        batch.extend(rows)
+        if len(batch) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if self.error is not None:
+            _reraise(self.error)
+        if self._batch:
+            self.queue.put((self._batch, self._encode))
+            self._batch = []
+
+    def drain(self):
+        """Wait until every row written so far has been handed to the underlying writer"""
+        self.flush()
+        self.queue.join()
+        if self.error is not None:
+            _reraise(self.error)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.queue.put(_DONE)
+            self.thread.join()
+        if self.error is not None:
+            _reraise(self.error)
+
+    def abort(self):
+        """Stop the thread without writing the rows that are still waiting"""
+        self._aborted = True
+        self._batch = []
+        self.queue.put(_DONE)
+        self.thread.join()